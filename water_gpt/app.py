@@ -1,7 +1,14 @@
 # pip install "Flask[async]"
+import asyncio
+import json
+import queue
+import threading
+import uuid
 from flask import *
 from flask_cors import CORS
 from tools import ChatBot
+from LLMChain import classifier_cache, semantic_cache, prompt_registry, tracer, llm_pool, micro_batcher
+from session_store import SessionStore
 
 
 app = Flask(__name__, static_folder='static',  # 靜態檔案資料夾
@@ -11,11 +18,14 @@ CORS(app)  # 允許跨域請求
 # 初始化聊天機器人
 chatbot = ChatBot()
 
-# 儲存訊息的列表
-messages = []
-
-# 儲存快捷訊息的列表 (是全域變數)
-quick_replies = []
+# 每位使用者的對話（訊息、對話歷史、機器人狀態、快捷訊息）依 session id 分開保存
+SESSION_COOKIE = "session_id"
+SESSION_HEADER = "X-Session-ID"
+SESSION_MAX = 10000  # 記憶體中最多保留的 session 數（LRU）
+SESSION_IDLE_TTL = 1800  # 閒置多久移出記憶體（秒）
+SESSION_SPILL_DIR = None  # 移出的 session 寫入的資料夾（例如 "./sessions"），None 代表直接捨棄
+SESSION_SPILL_TTL = 86400  # 寫到磁碟的 session 保留多久（秒）
+sessions = SessionStore(SESSION_MAX, SESSION_IDLE_TTL, SESSION_SPILL_DIR, SESSION_SPILL_TTL)
 
 # 回傳快捷訊息的列表
 return_quick_messages = []
@@ -32,6 +42,27 @@ def home():
     return render_template("index.html")
 
 
+def get_request_id():
+    """沿用前端或反向代理帶入的 X-Request-ID，沒有時產生新的編號。"""
+    return request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+
+
+def get_session():
+    """依 X-Session-ID 標頭或 session_id cookie 取得這位使用者的 session，沒有時建立新的（回應時寫入 cookie）。"""
+    if "session" not in g:
+        session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+        g.session = sessions.get(session_id)
+    return g.session
+
+
+@app.after_request
+def set_session_cookie(response):
+    session = g.get("session")
+    if session is not None and request.cookies.get(SESSION_COOKIE) != session.id:
+        response.set_cookie(SESSION_COOKIE, session.id, httponly=True, samesite="Lax")
+    return response
+
+
 @app.route("/send", methods=["POST"])
 async def send():
     data = request.json  # 解析message: userInput.value,並轉換成dit
@@ -41,7 +72,8 @@ async def send():
         return jsonify({"error": "Message is required"}), 400
 
     # 儲存用戶訊息
-    messages.append({"role": "user", "message": user_message})
+    session = get_session()
+    session.add_message("user", user_message)
     
     # 請輸入'XX地區是否有停水'"
     #if user_message == "停水查詢":
@@ -49,40 +81,117 @@ async def send():
     #    return jsonify({"reply": "生成回答: 請輸入詳細地區，例如：板橋區有停水嗎？"})
 
     # 使用 ChatBot 生成回答
-    bot_reply = await chatbot.chat_with_llm(user_message, quick_replies)
+    request_id = get_request_id()
+    bot_reply = await chatbot.chat_with_llm(user_message, request_id=request_id, session=session)
     
     # 儲存 AI 回覆
-    messages.append({"role": "bot", "message": bot_reply})
+    session.add_message("bot", bot_reply)
+
+    response = jsonify({"reply": f"生成回答: {bot_reply}", "request_id": request_id, "session_id": session.id})
+    response.headers["X-Request-ID"] = request_id
+    response.headers[SESSION_HEADER] = session.id
+    return response
+
 
-    return jsonify({"reply": f"生成回答: {bot_reply}"})
+def sse(event, data):
+    """組成一則 SSE 事件。"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route("/send_stream", methods=["POST"])
+def send_stream():
+    """
+    串流版的 /send（Server-Sent Events）。
+
+    事件依序為：
+      status：各階段完成（jailbreak、status、emotion、greeting、retrieve...）
+      delta：已生成的文字片段（問候回應、RAG 內容、停水公告）
+      done：完整回答（與 /send 的 reply 相同，不含「生成回答: 」前綴）
+      error：發生錯誤
+    """
+    data = request.json
+    user_message = data.get("message")
+
+    if not user_message:
+        return jsonify({"error": "Message is required"}), 400
+
+    session = get_session()
+    session.add_message("user", user_message)
+    events = queue.Queue()
+    request_id = get_request_id()
+
+    def run():
+        # ask() 在背景執行緒自己的 event loop 執行，事件透過佇列交給回應的產生器
+        try:
+            bot_reply = asyncio.run(chatbot.chat_with_llm(
+                user_message, on_event=lambda event, payload: events.put((event, payload)),
+                request_id=request_id, session=session,
+            ))
+            session.add_message("bot", bot_reply)
+            events.put(("done", {"reply": bot_reply, "request_id": request_id, "session_id": session.id}))
+        except Exception as e:
+            print(f"串流回答時發生錯誤: {e}")
+            events.put(("error", {"error": str(e), "request_id": request_id}))
+
+    threading.Thread(target=run, daemon=True).start()
+
+    def generate():
+        while True:
+            event, payload = events.get()
+            yield sse(event, payload)
+            if event in ("done", "error"):
+                break
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-ID": request_id,
+                             SESSION_HEADER: session.id})
 
 
 @app.route("/messages", methods=["GET"])
 def get_messages():
-    """ 取得所有聊天記錄 """
-    return jsonify(messages)
+    """ 取得這位使用者的聊天記錄 """
+    return jsonify(get_session().messages)
 
 
 @app.route("/clear", methods=['POST'])
 def clear():
-    global messages
-    count = len(messages)
-    messages = []
-    # 重置聊天機器人歷史
-    chatbot.history = [{
-        "role": "system",
-        "content": "你是一名客服幫助使用者解決問題"
-    }]
+    session = get_session()
+    count = len(session.messages)
+    # 重置這位使用者的訊息、聊天機器人歷史、狀態與快捷訊息
+    session.reset()
     return (f" 刪除 {count} 筆資料")
 
 
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    """ 取得分類器快取與 RAG 語意快取的命中率等統計、目前各系統提示詞的版本、LLM 後端狀態與 session 數 """
+    return jsonify({
+        "classifier_cache": classifier_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "prompt_versions": prompt_registry.versions(),
+        "llm_pool": llm_pool.stats(),
+        "micro_batcher": micro_batcher.stats() if micro_batcher is not None else None,
+        "sessions": sessions.stats(),
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """ Prometheus 格式的各階段耗時直方圖（每則訊息的明細寫在 trace.log）、LLM 後端狀態與微批次佇列統計 """
+    text = tracer.render_metrics() + llm_pool.render_metrics()
+    if micro_batcher is not None:
+        text += micro_batcher.render_metrics()
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/quick_messages", methods=["GET"])
 async def quick_messages():
-    """ 取得快捷訊息 """
-    if len(messages) < 2:
+    """ 取得這位使用者的快捷訊息 """
+    session = get_session()
+    quick_replies = session.quick_replies
+    if len(session.messages) < 2:
         return jsonify(hot_quick_messages)
     else:
-        # quick_replies 不能賦值 以免變成區域變數
         return_quick_messages = quick_replies
         if return_quick_messages:
             # 根據 被排除的快捷訊息 排除熱門快捷訊息
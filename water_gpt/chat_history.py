@@ -0,0 +1,103 @@
+import math
+import re
+
+# CJK 字元大約一個字一個 token，其餘文字（英數、標點）大約 4 個字元一個 token
+_CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text):
+    """以字元數估計 token 數，不需要載入 tokenizer。"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class History:
+    """
+    有上限的對話歷史：保留系統提示詞與最後 max_turns 輪（每輪為使用者與助理各一則）對話，
+    且對話內容的估計 token 數不超過 token_budget，超過時從最舊的對話開始捨棄。
+
+    物件不可變，add() 回傳新的 History，與舊的共用對話內容（每則訊息為 tuple），
+    不必像 list 一樣每則訊息都複製整份歷史；因為有上限，每個 session 佔用的記憶體固定。
+    迭代、索引與切片的結果與原本的 list 相同（{"role": ..., "content": ...}），system 在最前面。
+
+    Args:
+        system (str): 系統提示詞，None 代表沒有。
+        max_turns (int): 最多保留幾輪對話。
+        token_budget (int): 對話內容（不含系統提示詞）的估計 token 數上限，None 代表不限制。
+        count_tokens (callable): 計算 token 數的函式，預設以字元數估計；也可以傳入 tokenizer 的計算函式。
+    """
+
+    __slots__ = ("system", "max_turns", "token_budget", "count_tokens", "_entries", "_tokens")
+
+    def __init__(self, system=None, max_turns=5, token_budget=1000, count_tokens=estimate_tokens,
+                 _entries=(), _tokens=0):
+        self.system = system
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self._entries = _entries  # ((role, content, token 數), ...)
+        self._tokens = _tokens
+
+    @classmethod
+    def of(cls, messages, **limits):
+        """
+        從 [{"role": ..., "content": ...}] 格式的對話建立 History，已經是 History 時直接回傳。
+
+        Args:
+            messages (list): 對話，開頭的 system 訊息會成為系統提示詞。
+            **limits: max_turns、token_budget、count_tokens。
+        """
+        if isinstance(messages, cls):
+            return messages
+        system = None
+        if messages and messages[0]["role"] == "system":
+            system = messages[0]["content"]
+            messages = messages[1:]
+        history = cls(system, **limits)
+        for entry in messages:
+            history = history.add(entry["role"], entry["content"])
+        return history
+
+    def add(self, role, content):
+        """
+        回傳加上一則訊息後的新 History，原本的不變。
+
+        Args:
+            role (str): "user" 或 "assistant"。
+            content (str): 訊息內容。
+        """
+        entry = (role, content, self.count_tokens(content))
+        entries = self._entries + (entry,)
+        tokens = self._tokens + entry[2]
+        # 捨棄最舊的訊息，最新的一則一定保留
+        drop = max(0, len(entries) - self.max_turns * 2)
+        dropped = sum(e[2] for e in entries[:drop])
+        while self.token_budget is not None and tokens - dropped > self.token_budget and drop < len(entries) - 1:
+            dropped += entries[drop][2]
+            drop += 1
+        if drop:
+            entries = entries[drop:]
+            tokens -= dropped
+        return History(self.system, self.max_turns, self.token_budget, self.count_tokens, entries, tokens)
+
+    @property
+    def tokens(self):
+        """對話內容（不含系統提示詞）的估計 token 數。"""
+        return self._tokens
+
+    def to_list(self):
+        """轉成 [{"role": ..., "content": ...}] 格式（送給 LLM 或寫入磁碟）。"""
+        messages = [{"role": "system", "content": self.system}] if self.system is not None else []
+        return messages + [{"role": role, "content": content} for role, content, _ in self._entries]
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __len__(self):
+        return len(self._entries) + (self.system is not None)
+
+    def __getitem__(self, index):
+        return self.to_list()[index]
+
+    def __repr__(self):
+        return f"History({self.to_list()!r})"
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """正規化使用者輸入：全形轉半形（NFKC）、去除前後空白、合併連續空白。"""
+    text = unicodedata.normalize("NFKC", str(text))
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def prompt_version(chain):
+    """
+    計算分類器提示詞的版本雜湊。
+
+    以 PromptTemplate 的模板加上 LLM 的系統提示詞計算，提示詞一改版本就不同，
+    舊的快取自然不會再命中。系統提示詞在 prompt_registry 登錄時已算好版本，直接沿用。
+
+    Args:
+        chain (LLMChain): 要計算的分類器。
+
+    Returns:
+        str: 12 碼的 sha256 雜湊。
+    """
+    system = getattr(chain.llm, "prompt_version", None)
+    if system is None:
+        system = json.dumps(chain.llm._payload("")["messages"], ensure_ascii=False)
+    source = chain.prompt.template + system
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:12]
+
+
+class TTLCache:
+    """
+    執行緒安全、具 TTL 的 LRU 快取。
+
+    Args:
+        maxsize (int): 最多保留的筆數，0 代表停用快取。
+        ttl (float): 每筆資料的存活秒數。
+    """
+
+    def __init__(self, maxsize=2048, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (過期時間, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """回傳 (是否命中, value)。"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, predicate=None):
+        """清除 predicate(key) 為 True 的資料，未指定則全部清除；回傳清除筆數。"""
+        with self._lock:
+            if predicate is None:
+                count = len(self._data)
+                self._data.clear()
+                return count
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class CachedClassifier:
+    """
+    為只依賴使用者文字與固定提示詞的分類器加上結果快取。
+
+    快取鍵為 (分類器名稱, 提示詞版本雜湊, 正規化後的輸入)，predict/apredict
+    的用法與 LLMChain 相同，其餘屬性直接轉給原本的 chain。
+
+    Args:
+        name (str): 分類器名稱。
+        chain (LLMChain): 被包裝的分類器。
+        cache (TTLCache): 共用的快取。
+    """
+
+    def __init__(self, name, chain, cache):
+        self.name = name
+        self.chain = chain
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.chain, attr)
+
+    def _key(self, kwargs):
+        inputs = tuple((k, normalize_text(v)) for k, v in sorted(kwargs.items()))
+        return (self.name, prompt_version(self.chain), inputs)
+
+    def _lookup(self, key):
+        hit, value = self.cache.get(key)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return hit, value
+
+    def _store(self, key, value):
+        if value.strip():
+            self.cache.set(key, value)
+
+    def predict(self, **kwargs):
+        key = self._key(kwargs)
+        hit, value = self._lookup(key)
+        if hit:
+            return value
+        value = self.chain.predict(**kwargs)
+        self._store(key, value)
+        return value
+
+    async def apredict(self, **kwargs):
+        key = self._key(kwargs)
+        hit, value = self._lookup(key)
+        if hit:
+            return value
+        value = await self.chain.apredict(**kwargs)
+        self._store(key, value)
+        return value
+
+    def invalidate(self):
+        """清除此分類器的所有快取（例如執行期間更換了提示詞）。"""
+        return self.cache.invalidate(lambda key: key[0] == self.name)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,139 @@
+import re
+import unicodedata
+from datetime import date, timedelta
+
+# 範圍分隔（6/1~6/12、6/1到6/12）
+RANGE_SEPARATOR = re.compile(r"^(?:~|-|—|到|至)$")
+# 單一日期後面代表「之後」/「之前」的字詞
+AFTER_SUFFIX = re.compile(r"^(?:之後|以後|後|起|開始)")
+BEFORE_SUFFIX = re.compile(r"^(?:之前|以前|前|為止)")
+# 單一日期前面代表「到某日為止」的字詞
+BEFORE_PREFIX = re.compile(r"(?:到|至|截至|直到)$")
+
+# 日期運算式：完整日期（含民國年）、月/日、今天/明天/後天、X天後
+DATE_PATTERN = re.compile(
+    r"(?P<ymd>(?<!\d)(?P<y>\d{3}|\d{4})[/\-.年](?P<ym>\d{1,2})[/\-.月](?P<yd>\d{1,2})[日號]?)"
+    r"|(?P<md>(?<!\d)(?P<m>\d{1,2})(?:/|月)(?P<d>\d{1,2})(?!\d)[日號]?)"
+    r"|(?P<rel>大後天|後天|明天|明日|今天|今日)"
+    r"|(?P<after>(?P<n>\d{1,3}|[一二兩三四五六七八九十]{1,3})[天日](?:之後|以後|後))"
+)
+RELATIVE_DAYS = {"今天": 0, "今日": 0, "明天": 1, "明日": 1, "後天": 2, "大後天": 3}
+
+# 出現這些字詞代表有規則不處理的時間描述，交給 LLM
+UNSUPPORTED = re.compile(
+    r"週|周|星期|禮拜|月底|月初|月中|上旬|中旬|下旬|個月|昨|前天|最近|近期|這幾天|幾天|天內|日內"
+    r"|今晚|明晚|早上|上午|中午|下午|晚上|凌晨|\d點|年底|年初|過年|連假|假日"
+    r"|(?<![/月\d])\d{1,3}[天日]前|[一二兩三四五六七八九十]+[天日]前"
+)
+# 沒有找到日期運算式，卻有像日期的寫法（6.1、15號），交給 LLM
+DATE_LIKE = re.compile(r"\d{1,2}\.\d{1,2}|(?<![\d路街巷弄段樓])\d{1,2}[日號]|\d{1,2}月")
+
+CHINESE_DIGITS = {"一": 1, "二": 2, "兩": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+
+
+def chinese_to_int(text):
+    """把 1~99 的數字（阿拉伯或中文）轉成整數，無法轉換時回傳 None。"""
+    if text.isdigit():
+        return int(text)
+    if "十" not in text:
+        return CHINESE_DIGITS.get(text) if len(text) == 1 else None
+    tens, _, ones = text.partition("十")
+    if len(tens) > 1 or len(ones) > 1:
+        return None
+    tens_value = CHINESE_DIGITS.get(tens) if tens else 1
+    ones_value = CHINESE_DIGITS.get(ones) if ones else 0
+    if tens_value is None or ones_value is None:
+        return None
+    return tens_value * 10 + ones_value
+
+
+def to_date(match, today):
+    """把 DATE_PATTERN 的比對結果轉成 date，日期不合法時回傳 None。"""
+    try:
+        if match.group("ymd"):
+            year = int(match.group("y"))
+            if year < 1000:
+                year += 1911  # 民國年
+            return date(year, int(match.group("ym")), int(match.group("yd")))
+        if match.group("md"):
+            # 未指定年份時預設為今年
+            return date(today.year, int(match.group("m")), int(match.group("d")))
+    except ValueError:
+        return None
+    if match.group("rel"):
+        return today + timedelta(days=RELATIVE_DAYS[match.group("rel")])
+    days = chinese_to_int(match.group("n"))
+    if days is None:
+        return None
+    return today + timedelta(days=days)
+
+
+def result(start=None, end=None):
+    """組成與 TimeExtractor 相同格式的結果，沒有的日期為字串 "null"。"""
+    return {
+        "startDate": start.strftime("%Y-%m-%d") if start else "null",
+        "endDate": end.strftime("%Y-%m-%d") if end else "null",
+    }
+
+
+def parse_date_range(text, today=None):
+    """
+    解析使用者輸入中的日期範圍，規則與 TimeExtractor 的提示詞相同：
+
+      - 今天/明天/後天、X天後 → 單一日期（startDate = endDate）
+      - 6/1、2025/6/1、2025-06-01 → 單一日期，未指定年份時為今年
+      - 6/1~6/12、6/1-6/12、6/1到6/12 → 日期範圍
+      - 5/7之後、5/7以後 → 只有 startDate
+      - 6/30之前、6/30以前 → 只有 endDate
+      - 沒有任何時間資訊 → 兩者皆為 "null"
+
+    Args:
+        text (str): 使用者輸入。
+        today (date): 今天的日期，預設為系統日期（測試時可指定）。
+
+    Returns:
+        dict: {"startDate": "YYYY-MM-DD"/"null", "endDate": "YYYY-MM-DD"/"null"}；
+              無法確定時回傳 None，由呼叫端改用 LLM。
+    """
+    today = today or date.today()
+    norm = re.sub(r"\s+", "", unicodedata.normalize("NFKC", str(text)))
+    if UNSUPPORTED.search(norm):
+        return None
+
+    matches = list(DATE_PATTERN.finditer(norm))
+    if not matches:
+        if DATE_LIKE.search(norm):
+            return None
+        return result()
+
+    dates = [to_date(m, today) for m in matches]
+    if None in dates:
+        return None
+
+    if len(matches) == 1:
+        match, day = matches[0], dates[0]
+        before, after = norm[:match.start()], norm[match.end():]
+        if match.group("after"):
+            return result(day, day)
+        # 6/1~12：結束日只寫日期，沿用同一個月
+        tail = re.match(r"(?:~|-|—|到|至)(\d{1,2})(?![\d/月])[日號]?", after)
+        if tail and (match.group("md") or match.group("ymd")):
+            try:
+                end = day.replace(day=int(tail.group(1)))
+            except ValueError:
+                return None
+            return result(day, end) if day <= end else None
+        if AFTER_SUFFIX.match(after):
+            return result(day, None)
+        if BEFORE_SUFFIX.match(after) or BEFORE_PREFIX.search(before):
+            return result(None, day)
+        return result(day, day)
+
+    if len(matches) == 2:
+        between = norm[matches[0].end():matches[1].start()]
+        start, end = dates
+        if RANGE_SEPARATOR.match(between) and start <= end:
+            return result(start, end)
+
+    # 多個日期且不是明確的範圍，交給 LLM
+    return None
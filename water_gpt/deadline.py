@@ -0,0 +1,73 @@
+import asyncio
+import contextvars
+import time
+from contextlib import contextmanager
+
+# 目前這則訊息的截止時間（time.monotonic()）；asyncio task 建立時會複製 context，並行的分類器共用同一個截止時間
+_current_deadline = contextvars.ContextVar("water_gpt_deadline", default=None)
+
+
+@contextmanager
+def message_deadline(seconds):
+    """
+    在區塊內設定處理時限，巢狀使用時取較早的截止時間。
+
+    Args:
+        seconds (float): 時限秒數，None 代表不限制。
+    """
+    end = None if seconds is None else time.monotonic() + seconds
+    current = _current_deadline.get()
+    if current is not None and (end is None or current < end):
+        end = current
+    token = _current_deadline.set(end)
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+
+def remaining(cap=None):
+    """
+    剩餘秒數（不小於 0），與 cap 取較小者。
+
+    Args:
+        cap (float): 此階段自己的上限，None 代表只看截止時間。
+
+    Returns:
+        float: 剩餘秒數；沒有截止時間時回傳 cap（可能為 None）。
+    """
+    end = _current_deadline.get()
+    if end is None:
+        return cap
+    left = max(0.0, end - time.monotonic())
+    return left if cap is None else min(cap, left)
+
+
+def call_timeout(cap):
+    """
+    外部呼叫（LLM、embedding、停水查詢）使用的逾時秒數。
+
+    Raises:
+        asyncio.TimeoutError: 已超過截止時間，不必再送出請求。
+    """
+    left = remaining(cap)
+    if left is not None and left <= 0:
+        raise asyncio.TimeoutError("已超過這則訊息的處理時限")
+    return left
+
+
+async def within(awaitable, cap=None):
+    """
+    在剩餘時間（與 cap 取較小者）內等待 awaitable，逾時會取消它。
+
+    已超過截止時間時仍會讓 awaitable 執行一次，已經有結果的（例如前置路由決定的項目）照常回傳。
+
+    Raises:
+        asyncio.TimeoutError: 逾時。
+    """
+    task = asyncio.ensure_future(awaitable)
+    done, _ = await asyncio.wait({task}, timeout=remaining(cap))
+    if not done:
+        task.cancel()
+        raise asyncio.TimeoutError("已超過這則訊息的處理時限")
+    return task.result()
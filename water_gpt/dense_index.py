@@ -0,0 +1,88 @@
+import json
+import os
+
+import numpy as np
+
+VECTORS_FILE = "vectors.npy"
+METADATA_FILE = "metadata.json"
+
+
+class DenseIndex:
+    """
+    以單一 float32 矩陣保存的向量庫（知識庫只有數百篇文件，不需要 HNSW）。
+
+    文件向量先做 L2 正規化，查詢時以一次矩陣乘法算出所有文件的 cosine 相似度，
+    再用 argpartition 取前 top_k 篇。向量以 .npy 存在 directory，載入時以 memory map 開啟，
+    旁邊的 metadata.json 依相同順序保存每篇文件的內容與 metadata。
+
+    Args:
+        vectors (np.ndarray): (文件數, 維度) 的已正規化向量。
+        documents (list): [{"page_content": ..., "metadata": {...}}]，順序與 vectors 相同。
+    """
+
+    def __init__(self, vectors, documents):
+        self.vectors = vectors
+        self.documents = documents
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    @classmethod
+    def build(cls, vectors, documents, directory):
+        """
+        建立並儲存向量庫。
+
+        Args:
+            vectors (list): 每篇文件的 embedding。
+            documents (list): [{"page_content": ..., "metadata": {...}}]。
+            directory (str): 儲存的資料夾。
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, VECTORS_FILE), np.ascontiguousarray(cls.normalize(vectors)))
+        with open(os.path.join(directory, METADATA_FILE), "w", encoding="utf-8") as f:
+            json.dump(documents, f, ensure_ascii=False)
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory):
+        vectors = np.load(os.path.join(directory, VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(directory, METADATA_FILE), "r", encoding="utf-8") as f:
+            documents = json.load(f)
+        return cls(vectors, documents)
+
+    @staticmethod
+    def exists(directory):
+        return all(os.path.exists(os.path.join(directory, name)) for name in (VECTORS_FILE, METADATA_FILE))
+
+    def search(self, query_embeddings, top_k=5):
+        """
+        查詢多個問題各自最相關的 top_k 篇文件。
+
+        Args:
+            query_embeddings (list): 每個問題的 embedding。
+            top_k (int): 每個問題回傳幾篇。
+
+        Returns:
+            list: 每個問題的 [(文件, 距離)]，距離為正規化向量的平方 L2 距離（2 - 2 × cosine，
+                  與 Chroma 預設的 l2 距離同義），越小越相關。
+        """
+        queries = self.normalize(query_embeddings).reshape(-1, self.vectors.shape[1])
+        scores = queries @ self.vectors.T  # (問題數, 文件數)
+        top_k = min(top_k, scores.shape[1])
+        if top_k <= 0:
+            return [[] for _ in range(len(queries))]
+        if top_k < scores.shape[1]:
+            candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        else:
+            candidates = np.tile(np.arange(scores.shape[1]), (len(queries), 1))
+        results = []
+        for row, indices in zip(scores, candidates):
+            ranked = indices[np.argsort(-row[indices])]
+            results.append([(self.documents[i], float(2.0 - 2.0 * row[i])) for i in ranked])
+        return results
+
+    def __len__(self):
+        return len(self.documents)
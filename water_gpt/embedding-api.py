@@ -1,5 +1,6 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from opencc import OpenCC
 from sklearn.metrics.pairwise import cosine_similarity
 from pydantic import BaseModel
@@ -7,12 +8,23 @@ from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
 import json
 import os
+import hashlib
 import logging
 import time
 import asyncio
+import numpy as np
+from classifier_cache import normalize_text
+from embedding_cache import QueryCache
+from embedding_batcher import EmbeddingBatcher
+from dense_index import DenseIndex
+from typing import List, Union
 
 app = FastAPI()
 
+# 查詢的微批次：最多等 BATCH_WINDOW 秒或累積 BATCH_MAX_SIZE 筆合成一批（0 代表只合併已在排隊的查詢）
+BATCH_WINDOW = 0.005
+BATCH_MAX_SIZE = 32
+
 # 設置CORS
 app.add_middleware(
     CORSMiddleware,
@@ -34,6 +46,12 @@ class AppResponse(BaseModel):
 class EmbeddingRequest(BaseModel):
     request: str
     top_k: int = 5
+    return_embedding: bool = False  # 一併回傳問題的 embedding 與向量庫版本（供語意快取使用）
+
+class BatchEmbeddingRequest(BaseModel):
+    requests: List[str]
+    top_k: Union[int, List[int]] = 5  # 所有問題共用，或每個問題各自的 top_k
+    return_embedding: bool = False
 
 class ConnectionManager:
     def __init__(self):
@@ -74,8 +92,15 @@ class Embedding:
     def __init__(self):
         self.DATA_PATH = "../water_data_content_v3-class.json"
         self.DB_DIR    = "./db"
+        # 向量庫："chroma" 或 "dense"（numpy 矩陣，啟動不需要 Chroma 的持久層）
+        self.VECTOR_BACKEND = "chroma"
+        self.DENSE_DIR = "./dense_db"
         self.EMB_MODEL_NAME   = "C:/Users/ramune/Documents/Project/Python/rag/jina-embeddings-v3"
         self.EMB_MODEL_KWARGS = {"device": "cuda", "trust_remote_code": True}
+        # 問題向量與查詢結果的快取上限（MB），0 代表停用；存活秒數
+        self.QUERY_CACHE_MB = 64
+        self.RESULT_CACHE_MB = 16
+        self.QUERY_CACHE_TTL = 86400
         
         embedding = HuggingFaceEmbeddings(
             model_name=self.EMB_MODEL_NAME,
@@ -98,12 +123,174 @@ class Embedding:
         #    8: "App／網站使用與隱私政策",
         #}
         
-        self.vectordb = self.build_or_load_vectordb(embedding)
+        self.embedding = embedding
+        self.index_version = None  # 向量庫版本，重新建庫時改變
+        # 快捷訊息與 FAQ 標題會被重複查詢，相同問題（正規化後）不必再跑一次模型
+        self.query_cache = QueryCache(int(self.QUERY_CACHE_MB * 1024 * 1024), self.QUERY_CACHE_TTL)
+        self.result_cache = QueryCache(int(self.RESULT_CACHE_MB * 1024 * 1024), self.QUERY_CACHE_TTL)
+        self.vectordb = None
+        self.dense = None
+        if self.VECTOR_BACKEND == "dense":
+            self.dense = self.build_or_load_dense(embedding)
+        else:
+            self.vectordb = self.build_or_load_vectordb(embedding)
+        # search_batch 是否可以直接查詢 Chroma 的 collection（啟動時與單筆查詢比對）
+        self.batch_query_ok = self.vectordb is not None and self.check_batch_query()
 
-    def retrieve(self, query: str, top_k=5):
+    def embed_query(self, query: str):
+        """計算問題的 embedding（與 retrieve 使用相同的前處理），相同問題直接使用快取。"""
+        query = normalize_text(query)
+        hit, vector = self.query_cache.get(query)
+        if hit:
+            return vector.tolist()
         q_simp = self.tw2s.convert(query)
-        docs = self.vectordb.similarity_search_with_score(
-            query=q_simp,
+        vector = np.asarray(self.embedding.embed_query(q_simp), dtype=np.float32)
+        self.query_cache.set(query, vector, vector.nbytes)
+        return vector.tolist()
+
+    def result_key(self, query, top_k):
+        """
+        查詢結果快取的 key。包含 index_version：重新建庫後版本改變，舊的結果不會再命中。
+        問題向量只與模型有關，不受建庫影響，query_cache 以問題本身為 key。
+        """
+        return (self.index_version, normalize_text(query), top_k)
+
+    def retrieve(self, query: str, top_k=5):
+        key = self.result_key(query, top_k)
+        hit, results = self.result_cache.get(key)
+        if hit:
+            return results
+        results = self.search(self.embed_query(query), top_k)
+        self.result_cache.set(key, results, len(json.dumps(results, ensure_ascii=False).encode("utf-8")))
+        return results
+
+    def embed_queries(self, queries):
+        """
+        批次計算多個問題的 embedding，快取沒有的問題一次送進模型。
+
+        沒有設定 query_encode_kwargs 時 embed_documents 與 embed_query 的計算方式相同，只是一次處理多筆。
+        """
+        queries = [normalize_text(q) for q in queries]
+        vectors = {}
+        for q in queries:
+            hit, vector = self.query_cache.get(q)
+            if hit:
+                vectors[q] = vector
+        missing = list(dict.fromkeys(q for q in queries if q not in vectors))
+        if missing:
+            computed = np.asarray(self.embedding.embed_documents([self.tw2s.convert(q) for q in missing]), dtype=np.float32)
+            for q, vector in zip(missing, computed):
+                vectors[q] = vector
+                self.query_cache.set(q, vector, vector.nbytes)
+        return [vectors[q].tolist() for q in queries]
+
+    def search_batch(self, query_embeddings, top_ks):
+        """以多個問題的 embedding 一次查詢向量庫，回傳每個問題的文件列表（順序與輸入相同）。"""
+        if not query_embeddings:
+            return []
+        if self.dense is not None:
+            return [
+                [
+                    {
+                        "title": document["metadata"].get("title"),
+                        "content": self.s2tw.convert(document["page_content"]),
+                        "category": document["metadata"].get("category"),
+                        "confidence": distance
+                    }
+                    for document, distance in found[:top_k]
+                ]
+                for found, top_k in zip(self.dense.search(query_embeddings, max(top_ks)), top_ks)
+            ]
+        if not self.batch_query_ok:
+            return [self.search(query_embedding, top_k) for query_embedding, top_k in zip(query_embeddings, top_ks)]
+        return self.query_collection(query_embeddings, top_ks)
+
+    def query_collection(self, query_embeddings, top_ks):
+        """以多個問題的 embedding 一次查詢 Chroma，結果格式與 search 相同。"""
+        # LangChain 的 Chroma 沒有以多個向量一次查詢的方法，只能使用私有的 _collection；
+        # 單筆查詢（similarity_search_by_vector_with_relevance_scores）回傳的也是這裡的原始距離，
+        # 兩者一致由 check_batch_query 在啟動時確認
+        found = self.vectordb._collection.query(
+            query_embeddings=query_embeddings,
+            n_results=max(top_ks),
+            include=["documents", "metadatas", "distances"],
+        )
+        results = []
+        for documents, metadatas, distances, top_k in zip(found["documents"], found["metadatas"], found["distances"], top_ks):
+            results.append([
+                {
+                    "title": metadata.get("title"),
+                    "content": self.s2tw.convert(document),
+                    "category": metadata.get("category"),
+                    "confidence": float(distance)
+                }
+                for document, metadata, distance in list(zip(documents, metadatas, distances))[:top_k]
+            ])
+        return results
+
+    def check_batch_query(self, query="如何申請用水", top_k=5):
+        """
+        確認 query_collection 與 LangChain 的單筆查詢結果相同（文件順序與 confidence）。
+
+        升級 langchain_community 後 _collection 不存在或距離的換算改變時回傳 False，
+        search_batch 改為逐筆呼叫 search。
+        """
+        try:
+            query_embedding = self.embed_query(query)
+            single = self.search(query_embedding, top_k)
+            batch = self.query_collection([query_embedding], [top_k])[0]
+        except Exception as e:
+            print(f"批次查詢檢查失敗，改為逐筆查詢：{e}")
+            return False
+        same = [d["title"] for d in single] == [d["title"] for d in batch] and all(
+            abs(a["confidence"] - b["confidence"]) < 1e-4 for a, b in zip(single, batch)
+        )
+        if not same:
+            print("批次查詢與單筆查詢的結果不同，改為逐筆查詢")
+        return same
+
+    def retrieve_batch(self, queries, top_k=5):
+        """
+        批次查詢多個問題，結果順序與 queries 相同。
+
+        Args:
+            queries (list): 問題列表。
+            top_k (int | list): 所有問題共用的 top_k，或每個問題各自的 top_k。
+        """
+        top_ks = top_k if isinstance(top_k, list) else [top_k] * len(queries)
+        keys = [self.result_key(q, k) for q, k in zip(queries, top_ks)]
+        results = [None] * len(queries)
+        pending = []
+        for i, key in enumerate(keys):
+            hit, cached = self.result_cache.get(key)
+            if hit:
+                results[i] = cached
+            else:
+                pending.append(i)
+        embeddings = self.embed_queries([queries[i] for i in pending])
+        for i, found in zip(pending, self.search_batch(embeddings, [top_ks[i] for i in pending])):
+            results[i] = found
+            self.result_cache.set(keys[i], found, len(json.dumps(found, ensure_ascii=False).encode("utf-8")))
+        return results
+
+    def clear_caches(self):
+        """清除問題向量與查詢結果的快取（建庫後釋放舊版本結果佔用的記憶體；結果快取本身已以 index_version 區分）。"""
+        self.query_cache.clear()
+        self.result_cache.clear()
+
+    def cache_stats(self):
+        return {
+            "index_version": self.index_version,
+            "query_cache": self.query_cache.stats(),
+            "result_cache": self.result_cache.stats(),
+        }
+
+    def search(self, query_embedding, top_k=5):
+        """以問題的 embedding 查詢最相關的文件。"""
+        if self.dense is not None:
+            return self.search_batch([query_embedding], [top_k])[0]
+        docs = self.vectordb.similarity_search_by_vector_with_relevance_scores(
+            embedding=query_embedding,
             k=top_k#self.top_k
         )
 
@@ -129,9 +316,57 @@ class Embedding:
 
         return results
 
+    def load_index_version(self, directory=None):
+        """讀取建庫時記錄的向量庫版本，沒有記錄時以資料檔內容計算。"""
+        directory = directory or self.DB_DIR
+        version_path = os.path.join(directory, "index_version.txt")
+        if os.path.exists(version_path):
+            with open(version_path, "r", encoding="utf-8") as f:
+                return f.read().strip()
+        return self.save_index_version(directory)
+
+    def save_index_version(self, directory=None):
+        """以資料檔內容與建庫時間計算向量庫版本並記錄在 directory（預設為 DB_DIR）。"""
+        directory = directory or self.DB_DIR
+        digest = hashlib.sha256(str(time.time()).encode("utf-8"))
+        if os.path.exists(self.DATA_PATH):
+            with open(self.DATA_PATH, "rb") as f:
+                digest.update(f.read())
+        version = digest.hexdigest()[:12]
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "index_version.txt"), "w", encoding="utf-8") as f:
+            f.write(version)
+        return version
+
+    def build_or_load_dense(self, embedding):
+        """載入 DENSE_DIR 的 numpy 向量庫，不存在時以資料檔建庫（與 Chroma 建庫使用相同的文件與 embedding）。"""
+        if DenseIndex.exists(self.DENSE_DIR):
+            print("→ 載入已有向量庫（dense）")
+            self.index_version = self.load_index_version(self.DENSE_DIR)
+            return DenseIndex.load(self.DENSE_DIR)
+
+        print("→ 向量庫不存在，開始建庫（dense）…")
+        with open(self.DATA_PATH, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        documents = [
+            {
+                "page_content": self.tw2s.convert(item["page_content"]),
+                "metadata": {"title": item["title"], "category": str(item["category"])}
+            }
+            for item in data
+        ]
+        vectors = embedding.embed_documents([d["page_content"] for d in documents])
+        index = DenseIndex.build(vectors, documents, self.DENSE_DIR)
+        self.index_version = self.save_index_version(self.DENSE_DIR)
+        self.clear_caches()
+        print("✔ 向量庫建置完成")
+        return index
+
     def build_or_load_vectordb(self, embedding):
         if os.path.exists(self.DB_DIR):
             print("→ 載入已有向量庫")
+            self.index_version = self.load_index_version()
             return Chroma(persist_directory=self.DB_DIR, embedding_function=embedding)
 
         print("→ 向量庫不存在，開始建庫 …")
@@ -159,6 +394,8 @@ class Embedding:
             embedding,              # positional: embeddings
             persist_directory=self.DB_DIR
         )
+        self.index_version = self.save_index_version()
+        self.clear_caches()
         print("✔ 向量庫建置完成")
         return vectordb
 
@@ -166,6 +403,7 @@ if __name__ == "__main__":
     import uvicorn
     connection_manager = ConnectionManager()
     main = Embedding()
+    batcher = EmbeddingBatcher(main.retrieve_batch, main.embed_queries, window=BATCH_WINDOW, max_batch=BATCH_MAX_SIZE)
     
     @app.websocket("/ws/embedding")
     async def websocket_endpoint(websocket: WebSocket):
@@ -180,7 +418,16 @@ if __name__ == "__main__":
                 else:
                     top_k = 5
 
-                result = main.retrieve(request, top_k)#"True"
+                # 帶 requests（問題列表）時批次查詢
+                if data.get("requests") is not None:
+                    result = await batcher.run_exclusive(main.retrieve_batch, data["requests"], top_k)
+                    await connection_manager.send_personal_message(
+                        json.dumps({"responses": result}),
+                        websocket
+                    )
+                    continue
+
+                result, _ = await batcher.retrieve(request, top_k)#"True"
 
                 await connection_manager.send_personal_message(
                     json.dumps({"response": result}),
@@ -199,10 +446,44 @@ if __name__ == "__main__":
     @app.post("/embedding")
     async def get_embedding(request: EmbeddingRequest):
         try:
-            result = main.retrieve(request.request, request.top_k)
-            return {"response": result}
+            # 同時進來的查詢在佇列中合成一批計算
+            result, query_embedding = await batcher.retrieve(request.request, request.top_k, request.return_embedding)
+            if not request.return_embedding:
+                return {"response": result}
+            return {"response": result, "embedding": query_embedding, "index_version": main.index_version}
         except Exception as e:
             logging.error(f"Error processing embedding request: {e}")
             raise HTTPException(status_code=500, detail=str(e))
 
+    @app.post("/embedding/batch")
+    async def get_embedding_batch(request: BatchEmbeddingRequest):
+        """
+        一次查詢多個問題（離線評估、多問題檢索），問題在同一次模型計算中批次處理。
+
+        回傳 {"responses": [每個問題的文件列表]}，順序與 requests 相同；return_embedding 時另有
+        "embeddings" 與 "index_version"。
+        """
+        if isinstance(request.top_k, list) and len(request.top_k) != len(request.requests):
+            raise HTTPException(status_code=400, detail="top_k 的數量必須與 requests 相同")
+        try:
+            if not request.return_embedding:
+                return {"responses": await batcher.run_exclusive(main.retrieve_batch, request.requests, request.top_k)}
+            top_ks = request.top_k if isinstance(request.top_k, list) else [request.top_k] * len(request.requests)
+            embeddings = await batcher.run_exclusive(main.embed_queries, request.requests)
+            result = await batcher.run_exclusive(main.search_batch, embeddings, top_ks)
+            return {"responses": result, "embeddings": embeddings, "index_version": main.index_version}
+        except Exception as e:
+            logging.error(f"Error processing batch embedding request: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+    @app.get("/cache_stats")
+    async def cache_stats():
+        """問題向量快取與查詢結果快取的命中率等統計，以及微批次佇列的統計。"""
+        return {**main.cache_stats(), "batcher": batcher.stats()}
+
+    @app.get("/metrics")
+    async def metrics():
+        """Prometheus 格式的佇列深度、等待時間與每批問題數直方圖。"""
+        return PlainTextResponse(batcher.render_metrics(), media_type="text/plain; version=0.0.4")
+
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
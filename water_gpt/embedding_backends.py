@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import resource
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from dense_index import DenseIndex
+
+# torch：原本的 HuggingFace 模型（fp32）；int8：Linear 層動態量化為 int8（只在 CPU）；
+# onnx：以 ONNX Runtime 執行 MODEL_PATH 下的 ONNX 模型（可先用 quantize 指令轉成 int8）
+EMBEDDING_BACKENDS = ("torch", "int8", "onnx")
+ONNX_FILE = "onnx/model.onnx"
+ONNX_INT8_FILE = "onnx/model_int8.onnx"
+DATA_PATH = "../water_data_content_v3-class.json"
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    以 ONNX Runtime（CPU）計算 embedding：取 token 向量依 attention mask 平均後做 L2 正規化，
+    與 sentence-transformers 的 mean pooling 相同。
+
+    jina-embeddings-v3 的 ONNX 模型多一個 task_id 輸入（選擇 LoRA adapter），
+    以 task 指定，索引依模型 config.json 的 lora_adaptations。
+
+    Args:
+        model_path (str): 模型資料夾（tokenizer 與 config.json）。
+        onnx_file (str): ONNX 檔，相對於 model_path。
+        threads (int): ONNX Runtime 的執行緒數，None 代表由 ONNX Runtime 決定。
+        task (str): jina-embeddings-v3 的 task（例如 "text-matching"）。
+        max_length (int): tokenizer 的最大長度。
+        batch_size (int): 每次送進模型的文字數。
+    """
+
+    def __init__(self, model_path, onnx_file=ONNX_FILE, threads=None, task="text-matching", max_length=512, batch_size=32):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            os.path.join(model_path, onnx_file), sess_options=options, providers=["CPUExecutionProvider"],
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.task_id = None
+        if "task_id" in self.input_names:
+            with open(os.path.join(model_path, "config.json"), "r", encoding="utf-8") as f:
+                adaptations = json.load(f).get("lora_adaptations", [])
+            self.task_id = np.array(adaptations.index(task), dtype=np.int64)
+        self.max_length = max_length
+        self.batch_size = batch_size
+
+    def _embed(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(
+                texts[start:start + self.batch_size], padding=True, truncation=True,
+                max_length=self.max_length, return_tensors="np",
+            )
+            inputs = {name: encoded[name].astype(np.int64) for name in ("input_ids", "attention_mask", "token_type_ids")
+                      if name in self.input_names and name in encoded}
+            if self.task_id is not None:
+                inputs["task_id"] = self.task_id
+            tokens = self.session.run(None, inputs)[0]
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (tokens * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            vectors.append(DenseIndex.normalize(pooled))
+        return np.concatenate(vectors).tolist() if vectors else []
+
+    def embed_documents(self, texts):
+        return self._embed(list(texts))
+
+    def embed_query(self, text):
+        return self._embed([text])[0]
+
+
+def load_embedding(model_path, model_kwargs, backend="torch", threads=None, task="text-matching"):
+    """
+    依 backend 載入 embedding 模型，回傳有 embed_query / embed_documents 的物件。
+
+    Args:
+        model_path (str): 模型資料夾。
+        model_kwargs (dict): HuggingFaceEmbeddings 的 model_kwargs（torch、int8 使用）。
+        backend (str): "torch"、"int8" 或 "onnx"。
+        threads (int): CPU 執行緒數，None 代表不設定。
+        task (str): onnx 使用的 jina-embeddings-v3 task。
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"不支援的 EMBEDDING_BACKEND：{backend}，可用：{', '.join(EMBEDDING_BACKENDS)}")
+    if threads:
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+
+    if backend == "onnx":
+        onnx_file = ONNX_INT8_FILE if os.path.exists(os.path.join(model_path, ONNX_INT8_FILE)) else ONNX_FILE
+        print(f"→ 使用 ONNX Runtime：{onnx_file}")
+        return OnnxEmbeddings(model_path, onnx_file, threads=threads, task=task)
+
+    if backend == "int8":
+        # 動態量化只支援 CPU
+        model_kwargs = {**model_kwargs, "device": "cpu"}
+    embedding = HuggingFaceEmbeddings(model_name=model_path, model_kwargs=model_kwargs)
+    if backend == "int8":
+        try:
+            import torch
+            embedding._client = torch.quantization.quantize_dynamic(embedding._client, {torch.nn.Linear}, dtype=torch.qint8)
+            print("→ 使用 int8 動態量化")
+        except Exception as e:
+            print(f"int8 量化失敗，改用 fp32：{e}")
+    return embedding
+
+
+def quantize_onnx(model_path):
+    """把 ONNX_FILE 的權重動態量化為 int8，存成 ONNX_INT8_FILE（onnx backend 會優先使用）。"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    source = os.path.join(model_path, ONNX_FILE)
+    target = os.path.join(model_path, ONNX_INT8_FILE)
+    quantize_dynamic(source, target, weight_type=QuantType.QInt8)
+    print(f"✔ 已量化：{source} → {target}（{os.path.getsize(source) >> 20} MB → {os.path.getsize(target) >> 20} MB）")
+
+
+def _max_rss_mb():
+    # Linux 的 ru_maxrss 單位為 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _query_latency(embedding, texts):
+    started = time.perf_counter()
+    for text in texts:
+        embedding.embed_query(text)
+    return (time.perf_counter() - started) / len(texts)
+
+
+def check_accuracy(model_path, backend, data_path=DATA_PATH, threads=None, task="text-matching", top_k=5):
+    """
+    以 FAQ 語料比較 backend 與 fp32 的結果：
+
+    - 每個 FAQ 標題的問題向量與 fp32 的 cosine 相似度；
+    - 以 fp32 的文件向量建庫，分別用 fp32 與 backend 的問題向量查詢，前 1 名相同的比例與前 top_k 名的重疊率；
+    - 單筆查詢的平均耗時與載入模型後的記憶體用量。
+    """
+    with open(data_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    titles = [item["title"] for item in data]
+    contents = [item["page_content"] for item in data]
+    kwargs = {"device": "cpu", "trust_remote_code": True}
+
+    # 先載入待測的 backend，記憶體用量才不會被 fp32 模型蓋過
+    rss_before = _max_rss_mb()
+    candidate = load_embedding(model_path, kwargs, backend=backend, threads=threads, task=task)
+    candidate_rss = _max_rss_mb() - rss_before
+    reference = load_embedding(model_path, kwargs, backend="torch", threads=threads)
+
+    index = DenseIndex(DenseIndex.normalize(reference.embed_documents(contents)), [{"title": t} for t in titles])
+    fp32 = DenseIndex.normalize(reference.embed_documents(titles))
+    quantized = DenseIndex.normalize(candidate.embed_documents(titles))
+    cosine = (fp32 * quantized).sum(axis=1)
+
+    top1 = overlap = 0
+    for expected, found in zip(index.search(fp32, top_k), index.search(quantized, top_k)):
+        expected = [doc["title"] for doc, _ in expected]
+        found = [doc["title"] for doc, _ in found]
+        top1 += expected[0] == found[0]
+        overlap += len(set(expected) & set(found)) / top_k
+
+    sample = titles[:50]
+    print(f"backend：{backend}（FAQ {len(titles)} 筆）")
+    print(f"cosine 相似度（與 fp32）：平均 {cosine.mean():.4f}，最小 {cosine.min():.4f}")
+    print(f"前 1 名相同：{top1 / len(titles):.2%}，前 {top_k} 名重疊率：{overlap / len(titles):.2%}")
+    print(f"單筆查詢耗時：fp32 {_query_latency(reference, sample) * 1000:.1f} ms，"
+          f"{backend} {_query_latency(candidate, sample) * 1000:.1f} ms")
+    print(f"載入 {backend} 模型增加的記憶體：約 {candidate_rss:.0f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="embedding 模型的 CPU 最佳化（int8 量化、ONNX Runtime）")
+    parser.add_argument("command", choices=["check", "quantize"],
+                        help="check：以 FAQ 語料比較 backend 與 fp32 的準確度與速度；quantize：把 ONNX 模型量化為 int8")
+    parser.add_argument("--model", default=os.getenv("MODEL_PATH", "./models"), help="模型資料夾")
+    parser.add_argument("--backend", default=os.getenv("EMBEDDING_BACKEND", "int8"), choices=EMBEDDING_BACKENDS)
+    parser.add_argument("--data", default=os.getenv("DATA_PATH", DATA_PATH), help="FAQ 資料檔")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("EMBEDDING_THREADS", "0")) or None, help="CPU 執行緒數")
+    parser.add_argument("--task", default=os.getenv("EMBEDDING_TASK", "text-matching"), help="onnx 使用的 jina-embeddings-v3 task")
+    args = parser.parse_args()
+
+    if args.command == "quantize":
+        quantize_onnx(args.model)
+    else:
+        check_accuracy(args.model, args.backend, args.data, args.threads, args.task)
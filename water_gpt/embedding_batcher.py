@@ -0,0 +1,140 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import Histogram
+
+# 每批問題數與佇列深度的直方圖區間
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+# 佇列等待時間的直方圖區間（秒）
+QUEUE_WAIT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class EmbeddingBatcher:
+    """
+    embedding 服務內的動態微批次佇列。
+
+    各連線（HTTP / WebSocket）的查詢先放進佇列，最多等 window 秒或累積到 max_batch 筆就合成一批，
+    在背景執行緒以一次模型計算與一次向量庫查詢處理（retrieve_batch），再把結果分給各呼叫端。
+    模型計算期間新進來的查詢繼續排隊，下一批自然變大；模型只在同一條執行緒上執行，
+    event loop 不會被計算卡住。
+
+    Args:
+        retrieve_batch (callable): retrieve_batch(queries, top_ks) -> 每個問題的文件列表。
+        embed_queries (callable): embed_queries(queries) -> 每個問題的 embedding（需要回傳 embedding 時使用）。
+        window (float): 收集查詢的時間窗（秒）。
+        max_batch (int): 一批最多幾筆。
+    """
+
+    def __init__(self, retrieve_batch, embed_queries, window=0.005, max_batch=32):
+        self.retrieve_batch = retrieve_batch
+        self.embed_queries = embed_queries
+        self.window = window
+        self.max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+        self._queue = None
+        self._worker = None
+        self.queue_depth = Histogram(
+            "embedding_queue_depth", "Queries waiting in the embedding queue when a query arrives.", "queue",
+            BATCH_SIZE_BUCKETS,
+        )
+        self.queue_wait = Histogram(
+            "embedding_queue_wait_seconds", "Time queries wait in the embedding queue.", "queue", QUEUE_WAIT_BUCKETS,
+        )
+        self.batch_size = Histogram(
+            "embedding_batch_size", "Queries per embedding batch.", "queue", BATCH_SIZE_BUCKETS,
+        )
+        self.batches = 0
+        self.queries = 0
+
+    def _ensure_worker(self):
+        # 只在 event loop 內呼叫
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def retrieve(self, query, top_k=5, return_embedding=False):
+        """
+        排入佇列並等待這一批處理完。
+
+        Returns:
+            tuple: (文件列表, 問題的 embedding)；return_embedding 為 False 時 embedding 為 None。
+        """
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((query, top_k, return_embedding, future, time.perf_counter()))
+        self.queue_depth.observe("embedding", self._queue.qsize())
+        return await future
+
+    async def run_exclusive(self, fn, *args):
+        """在模型的執行緒上執行 fn（例如整批的 /embedding/batch），與佇列的批次依序執行。"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _collect(self):
+        """等第一筆查詢進來，再收集 window 秒內（最多 max_batch 筆）的查詢。"""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _process(self, batch):
+        # 在模型的執行緒上執行
+        queries = [query for query, *_ in batch]
+        results = self.retrieve_batch(queries, [top_k for _, top_k, *_ in batch])
+        wanted = [i for i, (_, _, return_embedding, *_) in enumerate(batch) if return_embedding]
+        embeddings = [None] * len(batch)
+        # 查詢時已算過的 embedding 都在快取中
+        for i, embedding in zip(wanted, self.embed_queries([queries[i] for i in wanted]) if wanted else []):
+            embeddings[i] = embedding
+        return list(zip(results, embeddings))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            now = time.perf_counter()
+            self.batches += 1
+            self.queries += len(batch)
+            self.batch_size.observe("embedding", len(batch))
+            for *_, enqueued in batch:
+                self.queue_wait.observe("embedding", now - enqueued)
+            try:
+                outcome = await loop.run_in_executor(self._executor, self._process, batch)
+            except Exception as e:
+                for _, _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, _, future, _), result in zip(batch, outcome):
+                # 呼叫端斷線時 future 已被取消
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "window": self.window,
+            "max_batch": self.max_batch,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "queries": self.queries,
+            "average_batch_size": self.queries / self.batches if self.batches else 0.0,
+        }
+
+    def render_metrics(self):
+        return "\n".join([
+            self.queue_depth.render(), self.queue_wait.render(), self.batch_size.render(),
+            "# HELP embedding_queue_length Queries currently waiting in the embedding queue.",
+            "# TYPE embedding_queue_length gauge",
+            f"embedding_queue_length {self.stats()['queue_depth']}",
+        ]) + "\n"
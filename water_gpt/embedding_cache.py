@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+
+# 每筆資料除了內容以外的估計額外記憶體（dict 項目、tuple、key 物件）
+ENTRY_OVERHEAD = 200
+
+
+class QueryCache:
+    """
+    以記憶體用量為上限、具 TTL 的 LRU 快取（embedding 服務的問題向量與查詢結果）。
+
+    Args:
+        max_bytes (int): 估計記憶體用量上限，0 代表停用快取。
+        ttl (float): 每筆資料的存活秒數。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=86400):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (過期時間, value, 估計位元組數)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """回傳 (是否命中, value)。"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value, _ = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                self._remove(key)
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, nbytes):
+        """
+        Args:
+            key: 快取的 key。
+            value: 快取的值。
+            nbytes (int): value 的估計位元組數。
+        """
+        size = nbytes + len(str(key).encode("utf-8")) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + self.ttl, value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        # 只在持有鎖時呼叫
+        self._bytes -= self._data.pop(key)[2]
+
+    def clear(self):
+        """全部清除（重新建庫時），回傳清除筆數。"""
+        with self._lock:
+            count = len(self._data)
+            self._data.clear()
+            self._bytes = 0
+            return count
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
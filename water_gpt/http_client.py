@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import aiohttp
+
+
+class AsyncHTTPClient:
+    """
+    共用的非同步 HTTP 用戶端（aiohttp），提供 keep-alive 連線池與逾時設定。
+
+    Flask[async] 每個請求都會建立新的 event loop，若在請求內建立 ClientSession，
+    請求結束連線就會被丟掉。因此 session 固定放在一條背景執行緒的 event loop 上，
+    呼叫端從任何 event loop await 都會共用同一個連線池；呼叫端取消時，
+    背景的 HTTP 請求也會一併取消。
+
+    Args:
+        limit (int): 連線池總連線數上限。
+        limit_per_host (int): 每個主機的連線數上限。
+        keepalive_timeout (float): 閒置連線保留秒數。
+        timeout (float): 單一請求總逾時秒數。
+        connect_timeout (float): 建立連線的逾時秒數。
+    """
+
+    def __init__(self, limit=100, limit_per_host=20, keepalive_timeout=30, timeout=60, connect_timeout=5):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="http-client", daemon=True).start()
+        return self._loop
+
+    async def _get_session(self):
+        # 只在背景 event loop 內呼叫
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def _run(self, coro):
+        """在背景 event loop 執行 coro，並讓呼叫端可以 await / 取消。"""
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        return await asyncio.wrap_future(future)
+
+    def _call_timeout(self, timeout):
+        """單次呼叫的逾時：總時間改為 timeout，保留建立連線的逾時（主機沒有回應連線時才能盡快換下一台）。"""
+        return aiohttp.ClientTimeout(total=timeout, connect=self.timeout.connect)
+
+    async def _request_json(self, method, url, timeout=None, **kwargs):
+        session = await self._get_session()
+        if timeout is not None:
+            kwargs["timeout"] = self._call_timeout(timeout)
+        async with session.request(method, url, **kwargs) as resp:
+            resp.raise_for_status()
+            return await resp.json(content_type=None)
+
+    async def _request_status(self, method, url, timeout=None):
+        session = await self._get_session()
+        kwargs = {"timeout": self._call_timeout(timeout)} if timeout is not None else {}
+        async with session.request(method, url, **kwargs) as resp:
+            return resp.status
+
+    async def get_status(self, url, timeout=None):
+        """GET 並只回傳 HTTP 狀態碼（健康檢查用），不解析內容。"""
+        return await self._run(self._request_status("GET", url, timeout=timeout))
+
+    def spawn(self, coro):
+        """在背景 event loop 上執行常駐的 coro（例如定期健康檢查），回傳 concurrent.futures.Future。"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    async def post_json(self, url, payload, headers=None, timeout=None):
+        """POST JSON 並回傳解析後的 JSON 回應。"""
+        return await self._run(self._request_json("POST", url, json=payload, headers=headers, timeout=timeout))
+
+    async def get_json(self, url, params=None, headers=None, timeout=None):
+        """GET 並回傳解析後的 JSON 回應，值為 None 的參數會被略過。"""
+        if params:
+            params = {k: v for k, v in params.items() if v is not None}
+        return await self._run(self._request_json("GET", url, params=params, headers=headers, timeout=timeout))
+
+    async def stream_lines(self, url, payload, headers=None, timeout=None):
+        """
+        POST JSON 並逐行回傳回應內容（供 SSE / chunked 串流使用）。
+
+        背景 event loop 讀到一行就丟進呼叫端的佇列，呼叫端停止迭代時背景請求會被取消。
+
+        Yields:
+            str: 去除換行後的一行文字，空行會被略過。
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+
+        async def reader():
+            try:
+                session = await self._get_session()
+                kwargs = {"json": payload, "headers": headers}
+                if timeout is not None:
+                    kwargs["timeout"] = self._call_timeout(timeout)
+                async with session.post(url, **kwargs) as resp:
+                    resp.raise_for_status()
+                    async for raw in resp.content:
+                        line = raw.decode("utf-8").strip()
+                        if line:
+                            loop.call_soon_threadsafe(queue.put_nowait, line)
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+
+        future = asyncio.run_coroutine_threadsafe(reader(), self._ensure_loop())
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+    def close(self):
+        """關閉連線池與背景 event loop。"""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), loop).result()
+            self._session = None
+        loop.call_soon_threadsafe(loop.stop)
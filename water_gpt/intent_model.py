@@ -0,0 +1,350 @@
+import argparse
+import json
+import os
+import pickle
+import re
+import time
+from classifier_cache import normalize_text, CachedClassifier
+
+INTENT_TASKS = ("question", "wrong_question", "greeting")
+MODEL_PATH = "./models/intent_model.pkl"
+LABELS_PATH = "./test/intent_labels.json"
+FAQ_DATA_PATH = "../water_data_content_v3-class.json"
+LOG_PATH = "./test/output.log"
+# 每個類別至少要有的樣本數，不足時該任務不訓練（全部交給 LLM）
+MIN_CLASS_SAMPLES = 20
+
+# 補充知識庫沒有的類型：問候/答謝/告別、閒聊陳述、與水務無關的提問
+# 與水務無關的提問只作為 label 指令的標註對象，wrong_question 不使用這些手寫的標註
+GREETING_SEEDS = [
+    "你好", "您好", "哈囉", "嗨", "Hi", "Hello", "你好呀", "哈囉你好", "早安", "午安", "晚安", "早上好",
+    "下午好", "晚上好", "謝謝", "謝謝你", "感謝", "感謝您的協助", "太好了", "辛苦了", "謝謝你的幫忙",
+    "再見", "掰掰", "拜拜", "bye", "好的謝謝", "晚安囉", "謝啦",
+]
+STATEMENT_SEEDS = [
+    "好的", "嗯嗯", "我知道了", "沒事了", "哈哈", "今天天氣真好", "我吃飽了", "我住在台中",
+    "我家在高雄", "了解", "收到", "原來如此", "我剛下班", "等一下再說",
+]
+OFF_TOPIC_SEEDS = [
+    "今天天氣如何？", "推薦一部電影", "台灣最高的山是哪座？", "幫我寫一首詩", "股票明天會漲嗎？",
+    "怎麼煮咖啡？", "1+1等於多少？", "你喜歡什麼顏色？", "附近有什麼好吃的？", "電腦當機怎麼辦？",
+    "明天要穿什麼衣服？", "貓咪可以吃巧克力嗎？", "怎麼學好英文？", "高鐵票怎麼買？",
+]
+QUESTION_MARKERS = re.compile(r"[?？]|嗎|什麼|甚麼|如何|怎麼|怎樣|為何|為什麼|哪|多少|是否|可否|能否|何謂|何時")
+
+
+def build_corpus(faq_path=FAQ_DATA_PATH):
+    """
+    建立弱標註的訓練資料。
+
+    來源為知識庫 FAQ 標題與上方的補充範例，只標註 question 與 greeting。
+    wrong_question 不使用弱標註：FAQ 標題全部與水務相關，負例只有少數手寫範例，
+    模型會學成「問句就是水務問題」，因此只用 LLM 的標註（load_llm_labels）。
+
+    Returns:
+        dict: 文字 -> {任務: "是"/"否"}。
+    """
+    corpus = {}
+
+    def label(text, **labels):
+        corpus.setdefault(text, {}).update(labels)
+
+    try:
+        with open(faq_path, "r", encoding="utf-8") as f:
+            for item in json.load(f):
+                title = item["title"]
+                label(title, greeting="否")
+                if QUESTION_MARKERS.search(title):
+                    label(title, question="是")
+    except Exception as e:
+        print(f"讀取FAQ檔案發生錯誤：{e}")
+
+    for text in GREETING_SEEDS:
+        label(text, greeting="是", question="否")
+    for text in STATEMENT_SEEDS:
+        label(text, greeting="否", question="否")
+    for text in OFF_TOPIC_SEEDS:
+        label(text, greeting="否", question="是")
+    return corpus
+
+
+def load_log_labels(log_path=LOG_PATH):
+    """讀取 output.log 中 LLM 的判斷結果（問候語、是否為水務相關問題）。"""
+    labels = {}
+    try:
+        current = None
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                match = re.match(r"\d{4}-\d\d-\d\d [\d:,]+ - (.*)", line.rstrip("\n"))
+                if not match:
+                    continue
+                message = match.group(1)
+                if message.startswith("使用者輸入:"):
+                    current = message[len("使用者輸入:"):]
+                elif current is None:
+                    continue
+                elif message.startswith("問候語判斷結果:"):
+                    labels.setdefault(current, {})["greeting"] = message.split(":", 1)[1]
+                elif message.startswith("是否為水務相關問題:"):
+                    labels.setdefault(current, {})["wrong_question"] = message.split(":", 1)[1]
+    except Exception as e:
+        print(f"讀取log檔案發生錯誤：{e}")
+    return labels
+
+
+def load_labels(path=LABELS_PATH):
+    """讀取 `label` 指令產生的 LLM 標註，檔案不存在時回傳空字典。"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_llm_labels(labels_path=LABELS_PATH, log_path=LOG_PATH):
+    """LLM 的標註：output.log 的判斷結果加上 `label` 指令的標註（後者優先）。"""
+    labels = load_log_labels(log_path)
+    for text, values in load_labels(labels_path).items():
+        labels.setdefault(text, {}).update(values)
+    return labels
+
+
+def merge_labels(corpus, llm_labels):
+    """弱標註加上 LLM 標註（LLM 優先），回傳新的字典。"""
+    merged = {text: dict(labels) for text, labels in corpus.items()}
+    for text, labels in llm_labels.items():
+        merged.setdefault(text, {}).update(labels)
+    return merged
+
+
+def to_dataset(corpus):
+    """文字 -> 標註 轉為 任務 -> (文字列表, 標註列表)。"""
+    dataset = {task: ([], []) for task in INTENT_TASKS}
+    for text, labels in corpus.items():
+        for task, value in labels.items():
+            if task in dataset and value in ("是", "否"):
+                dataset[task][0].append(normalize_text(text))
+                dataset[task][1].append(value)
+    return dataset
+
+
+def fit_task(texts, labels):
+    """訓練單一任務；任一類別少於 MIN_CLASS_SAMPLES 筆時回傳 None（交給 LLM）。"""
+    if any(labels.count(value) < MIN_CLASS_SAMPLES for value in ("是", "否")):
+        return None
+    return make_pipeline().fit(texts, labels)
+
+
+def make_pipeline():
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline as sk_make_pipeline
+    return sk_make_pipeline(
+        TfidfVectorizer(analyzer="char_wb", ngram_range=(1, 3), sublinear_tf=True),
+        LogisticRegression(C=10.0, class_weight="balanced", max_iter=1000),
+    )
+
+
+class IntentModel:
+    """
+    本地的是/否意圖分類器（char n-gram TF-IDF + 邏輯迴歸），
+    可取代 question_classifier、wrong_question_classifier、greeting_classifier。
+
+    Args:
+        models (dict): 任務名稱 -> 已訓練的 sklearn pipeline。
+    """
+
+    def __init__(self, models):
+        self.models = models
+
+    @classmethod
+    def train(cls, dataset):
+        models = {}
+        for task, (texts, labels) in dataset.items():
+            model = fit_task(texts, labels)
+            if model is None:
+                print(f"→ {task} 的是／否樣本不足 {MIN_CLASS_SAMPLES} 筆，略過（交給 LLM）")
+                continue
+            models[task] = model
+        return cls(models)
+
+    def predict(self, task, text):
+        """回傳 (標註, 信心度)；沒有此任務的模型時回傳 (None, 0.0)。"""
+        model = self.models.get(task)
+        if model is None:
+            return None, 0.0
+        proba = model.predict_proba([normalize_text(text)])[0]
+        best = proba.argmax()
+        return model.classes_[best], float(proba[best])
+
+    def save(self, path=MODEL_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump(self.models, f)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        """讀取模型，檔案不存在或未安裝 scikit-learn 時回傳 None（全部改用 LLM）。"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                return cls(pickle.load(f))
+        except Exception as e:
+            print(f"讀取意圖模型發生錯誤：{e}")
+            return None
+
+
+class LocalFirstClassifier:
+    """
+    先用本地模型判斷，信心度達門檻就直接回傳「是」/「否」，否則交給原本的分類器。
+
+    predict/apredict 的用法與 LLMChain 相同，其餘屬性直接轉給原本的分類器。
+
+    Args:
+        task (str): 任務名稱（question、wrong_question、greeting）。
+        classifier: 原本的分類器（LLMChain 或 CachedClassifier）。
+        model (IntentModel): 本地模型，None 代表停用。
+        threshold (float): 信心度門檻。
+    """
+
+    def __init__(self, task, classifier, model, threshold=0.9):
+        self.task = task
+        self.classifier = classifier
+        self.model = model
+        self.threshold = threshold
+        self.local = 0
+        self.fallback = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.classifier, attr)
+
+    def _local(self, text):
+        if self.model is None:
+            return None
+        label, confidence = self.model.predict(self.task, text)
+        if label is not None and confidence >= self.threshold:
+            self.local += 1
+            return label
+        self.fallback += 1
+        return None
+
+    def predict(self, **kwargs):
+        label = self._local(kwargs.get("text", ""))
+        if label is not None:
+            return label
+        return self.classifier.predict(**kwargs)
+
+    async def apredict(self, **kwargs):
+        label = self._local(kwargs.get("text", ""))
+        if label is not None:
+            return label
+        return await self.classifier.apredict(**kwargs)
+
+    def stats(self):
+        total = self.local + self.fallback
+        return {
+            "local": self.local,
+            "fallback": self.fallback,
+            "local_rate": self.local / total if total else 0.0,
+        }
+
+
+def label_with_llm(corpus, output_path=LABELS_PATH):
+    """以線上的 LLM 分類器標註語料，作為訓練與評估的標準答案。"""
+    import LLMChain
+    chains = {
+        "question": LLMChain.question_classifier,
+        "wrong_question": LLMChain.wrong_question_classifier,
+        "greeting": LLMChain.greeting_classifier,
+    }
+    labels = load_labels(output_path)
+    for i, text in enumerate(corpus, 1):
+        for task, chain in chains.items():
+            # 取最內層的 LLMChain，避免用到本地模型與快取
+            while isinstance(chain, (LocalFirstClassifier, CachedClassifier)):
+                chain = chain.classifier if isinstance(chain, LocalFirstClassifier) else chain.chain
+            labels.setdefault(text, {})[task] = chain.predict(text=text).strip()
+        print(f"[{i}/{len(corpus)}] {text} -> {labels[text]}")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(labels, f, ensure_ascii=False, indent=2)
+    return labels
+
+
+def evaluate(corpus, llm_labels, threshold, folds=5):
+    """
+    以 LLM 的標註為標準答案評估各任務。
+
+    只評估有 LLM 標註的文字：依 folds 分組，每組以其餘的資料（弱標註與其他組的 LLM 標註）訓練，
+    再與該組的 LLM 標註比較，評估的文字不會出現在訓練資料中。
+    某一組訓練資料不足而沒有模型時，該組全部視為交給 LLM（不計入涵蓋）。
+    """
+    from sklearn.model_selection import KFold
+    for task in INTENT_TASKS:
+        samples = [(text, labels[task]) for text, labels in llm_labels.items() if labels.get(task) in ("是", "否")]
+        if not samples:
+            print(f"{task}: 沒有 LLM 標註，無法評估（先執行 label）")
+            continue
+        evaluated = correct = covered = covered_correct = 0
+        misrouted = []
+        elapsed = 0.0
+        n_splits = min(folds, len(samples))
+        splits = KFold(n_splits=n_splits, shuffle=True, random_state=0).split(samples) if n_splits >= 2 else [([], [0])]
+        for _, test_idx in splits:
+            held_out = {samples[i][0] for i in test_idx}
+            train_corpus = merge_labels(
+                {text: labels for text, labels in corpus.items() if text not in held_out},
+                {text: labels for text, labels in llm_labels.items() if text not in held_out},
+            )
+            texts, labels = to_dataset(train_corpus)[task]
+            model = fit_task(texts, labels)
+            if model is None:
+                continue
+            evaluated += len(test_idx)
+            for i in test_idx:
+                text, expected = samples[i]
+                start = time.perf_counter()
+                proba = model.predict_proba([normalize_text(text)])[0]
+                elapsed += time.perf_counter() - start
+                predicted = model.classes_[proba.argmax()]
+                correct += predicted == expected
+                if proba.max() >= threshold:
+                    covered += 1
+                    covered_correct += predicted == expected
+                    if predicted != expected:
+                        misrouted.append((text, expected, predicted))
+        total = len(samples)
+        summary = f"{task}: LLM 標註樣本 {total}（是 {sum(v == '是' for _, v in samples)}／否 {sum(v == '否' for _, v in samples)}）"
+        if not evaluated:
+            print(f"{summary}，訓練資料不足，沒有模型（全部交給 LLM）")
+            continue
+        print(f"{summary}，有模型 {evaluated} 筆，準確率 {correct / evaluated:.1%}，"
+              f"門檻 {threshold} 涵蓋率 {covered / total:.1%}，"
+              f"涵蓋部分準確率 {(covered_correct / covered if covered else 0):.1%}，"
+              f"平均推論 {elapsed / total * 1000:.3f} ms")
+        for text, expected, predicted in misrouted[:10]:
+            print(f"    誤判：{text}（LLM {expected}，模型 {predicted}）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地意圖模型的訓練與評估")
+    parser.add_argument("command", choices=["label", "train", "eval"],
+                        help="label：以 LLM 標註語料；train：訓練並儲存模型；eval：與 LLM 標註比較準確率")
+    parser.add_argument("--labels", default=LABELS_PATH, help="LLM 標註檔路徑")
+    parser.add_argument("--model", default=MODEL_PATH, help="模型儲存路徑")
+    parser.add_argument("--threshold", type=float, default=0.9, help="信心度門檻")
+    args = parser.parse_args()
+
+    corpus = build_corpus()
+    if args.command == "label":
+        label_with_llm(corpus, args.labels)
+    else:
+        llm_labels = load_llm_labels(args.labels)
+        if args.command == "train":
+            # LLM 標註優先於弱標註
+            dataset = to_dataset(merge_labels(corpus, llm_labels))
+            IntentModel.train(dataset).save(args.model)
+            for task, (texts, labels) in dataset.items():
+                print(f"→ {task}: {len(texts)} 筆（是 {labels.count('是')}／否 {labels.count('否')}）")
+            print(f"✔ 模型已儲存至 {args.model}")
+        else:
+            evaluate(corpus, llm_labels, args.threshold)
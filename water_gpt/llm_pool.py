@@ -0,0 +1,317 @@
+import asyncio
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+
+class Backend:
+    """
+    一個 OpenAI 相容的 LLM 後端，附帶斷路器狀態與統計。
+
+    斷路器：連續失敗 failure_threshold 次後開啟（不再分配請求），reset_timeout 秒後進入半開，
+    只放行一個試探請求，成功則關閉、失敗則再次開啟。
+
+    Args:
+        url (str): chat completions 的網址。
+        weight (float): 權重，越大分到的請求越多。
+        failure_threshold (int): 連續失敗幾次後開啟斷路器。
+        reset_timeout (float): 斷路器開啟後多久進入半開（秒）。
+    """
+
+    def __init__(self, url, weight=1.0, failure_threshold=3, reset_timeout=30.0):
+        self.url = url
+        self.weight = weight
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.healthy = True  # 最近一次健康檢查的結果
+        self.outstanding = 0  # 進行中的請求數
+        self.consecutive_failures = 0
+        self.state = "closed"  # closed / open / half_open
+        self.opened_at = 0.0
+        self.trial_in_flight = False  # 半開時是否已有試探請求
+        self.requests = 0
+        self.failures = 0
+        self.latency = None  # 成功請求耗時的指數移動平均（秒）
+
+    def available(self, now):
+        """此後端目前是否可以接受請求（健康且斷路器允許）。"""
+        if not self.healthy:
+            return False
+        if self.state == "open" and now - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self.trial_in_flight = False
+        if self.state == "open":
+            return False
+        if self.state == "half_open":
+            return not self.trial_in_flight
+        return True
+
+    def score(self):
+        """least-outstanding-requests 的分數（依權重調整），越小越優先。"""
+        return (self.outstanding + 1) / self.weight
+
+    def record_success(self, elapsed):
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.trial_in_flight = False
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+
+    def record_failure(self, now):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.trial_in_flight = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = now
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "healthy": self.healthy,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "latency": self.latency,
+        }
+
+
+class BackendPool:
+    """
+    多個 LLM 後端的負載平衡：依權重的 least-outstanding-requests 分配、定期健康檢查、
+    每個後端各自的斷路器，以及小型分類器請求的 hedging
+    （主要請求 hedge_delay 秒內沒回應就再送一份到另一個後端，取先回來的結果）。
+    非同步請求失敗時會改送另一個後端重試一次。
+
+    只有一個後端時行為與直接呼叫該後端相同（不會 hedging）。
+
+    Args:
+        backends (list): [{"url": ..., "weight": ...}, ...]。
+        http_client (AsyncHTTPClient): 共用的連線池。
+        failure_threshold (int): 連續失敗幾次後開啟斷路器。
+        reset_timeout (float): 斷路器開啟後多久進入半開（秒）。
+        health_interval (float): 健康檢查間隔（秒），None 代表不做健康檢查。
+        health_path (str): 健康檢查路徑（vLLM 與 llama.cpp server 皆提供 /health）。
+        hedge_delay (float): hedging 的等待秒數，None 代表停用。
+    """
+
+    def __init__(self, backends, http_client, failure_threshold=3, reset_timeout=30.0,
+                 health_interval=10.0, health_path="/health", hedge_delay=None):
+        self.backends = [
+            Backend(b["url"], b.get("weight", 1.0), failure_threshold, reset_timeout) for b in backends
+        ]
+        self.http_client = http_client
+        self.health_interval = health_interval
+        self.health_path = health_path
+        self.hedge_delay = hedge_delay
+        self.hedges = 0  # 送出的 hedging 請求數
+        self.hedge_wins = 0  # hedging 請求比主要請求先回來的次數
+        self.retries = 0  # 失敗後改送其他後端的次數
+        self._health_future = None
+        self._lock = threading.Lock()
+
+    def _health_url(self, backend):
+        parts = urlsplit(backend.url)
+        return f"{parts.scheme}://{parts.netloc}{self.health_path}"
+
+    async def _health_loop(self):
+        # 在 http_client 的背景 event loop 上常駐執行
+        while True:
+            for backend in self.backends:
+                try:
+                    status = await self.http_client.get_status(self._health_url(backend), timeout=self.health_interval)
+                    # 能連上且不是 5xx 就視為存活（部分 OpenAI 相容服務沒有 /health，會回 404）
+                    backend.healthy = status < 500
+                except Exception:
+                    backend.healthy = False
+            await asyncio.sleep(self.health_interval)
+
+    def _start_health_checks(self):
+        if self.health_interval is None or self._health_future is not None:
+            return
+        with self._lock:
+            if self._health_future is None:
+                self._health_future = self.http_client.spawn(self._health_loop())
+
+    def pick(self, exclude=()):
+        """
+        選出分數最低（進行中請求數 / 權重）的可用後端，同分時選平均耗時較短的。
+
+        所有後端都不可用時仍從全部後端中選擇，讓請求有機會成功而不是直接失敗。
+
+        Args:
+            exclude (tuple): 不要選的後端（hedging 時排除主要請求的後端）。
+
+        Returns:
+            Backend: 選中的後端，沒有可選的後端時回傳 None。
+        """
+        self._start_health_checks()
+        now = time.monotonic()
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude and b.available(now)]
+            if not candidates:
+                candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            # 進行中請求數相同時，優先選平均耗時較短的（還沒有紀錄的視為 0，讓它有機會被選到）
+            best = min((b.score(), b.latency or 0.0) for b in candidates)
+            backend = random.choice([b for b in candidates if (b.score(), b.latency or 0.0) == best])
+            backend.outstanding += 1
+            backend.requests += 1
+            if backend.state == "half_open":
+                backend.trial_in_flight = True
+            return backend
+
+    def release(self, backend, started, ok):
+        """
+        請求結束時更新進行中請求數與斷路器。
+
+        ok 為 None 代表請求被取消（hedging 的另一份先回來、呼叫端逾時），不影響斷路器。
+        """
+        with self._lock:
+            backend.outstanding -= 1
+            if ok is None:
+                backend.trial_in_flight = False
+            elif ok:
+                backend.record_success(time.monotonic() - started)
+            else:
+                backend.record_failure(time.monotonic())
+
+    async def _send(self, backend, payload, headers, timeout):
+        started = time.monotonic()
+        ok = False
+        try:
+            data = await self.http_client.post_json(backend.url, payload, headers=headers, timeout=timeout)
+            ok = True
+            return data
+        except asyncio.CancelledError:
+            ok = None
+            raise
+        finally:
+            self.release(backend, started, ok)
+
+    async def post_json(self, payload, headers=None, timeout=None, hedge=False):
+        """
+        送出 chat completions 請求並回傳 JSON 回應。
+
+        Args:
+            payload (dict): 請求內容。
+            headers (dict): HTTP 標頭。
+            timeout (float): 逾時秒數。
+            hedge (bool): 是否允許 hedging（只用在輸出很短的分類器）。
+        """
+        primary = self.pick()
+        task = asyncio.ensure_future(self._send(primary, payload, headers, timeout))
+        if not hedge or self.hedge_delay is None or len(self.backends) < 2:
+            try:
+                return await task
+            except Exception as e:
+                return await self._failover(primary, payload, headers, timeout, e)
+
+        pending = {task}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.hedge_delay)
+            if done:
+                if task.exception() is not None:
+                    return await self._failover(primary, payload, headers, timeout, task.exception())
+                return task.result()
+            secondary = self.pick(exclude=(primary,))
+            if secondary is None:
+                return await task
+            self.hedges += 1
+            hedge_task = asyncio.ensure_future(self._send(secondary, payload, headers, timeout))
+            pending = {task, hedge_task}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    if finished.exception() is None:
+                        if finished is hedge_task:
+                            self.hedge_wins += 1
+                        return finished.result()
+                    error = finished.exception()
+            raise error
+        finally:
+            # 取先回來的結果，另一份（或呼叫端被取消時的所有請求）取消
+            for other in pending:
+                other.cancel()
+
+    async def _failover(self, failed, payload, headers, timeout, error):
+        """失敗的請求改送到另一個後端重試一次，沒有其他後端時拋出原本的例外。"""
+        backend = self.pick(exclude=(failed,))
+        if backend is None:
+            raise error
+        self.retries += 1
+        return await self._send(backend, payload, headers, timeout)
+
+    def post_sync(self, payload, headers=None, timeout=None):
+        """同步版本（LLM._call 使用），不做 hedging。"""
+        backend = self.pick()
+        started = time.monotonic()
+        ok = False
+        try:
+            resp = requests.post(backend.url, headers=headers, json=payload, timeout=timeout)
+            resp.raise_for_status()
+            ok = True
+            return resp.json()
+        finally:
+            self.release(backend, started, ok)
+
+    async def stream_lines(self, payload, headers=None, timeout=None):
+        """串流版本，逐行回傳選中後端的回應，不做 hedging。"""
+        backend = self.pick()
+        started = time.monotonic()
+        ok = False
+        try:
+            async for line in self.http_client.stream_lines(backend.url, payload, headers=headers, timeout=timeout):
+                yield line
+            ok = True
+        except (asyncio.CancelledError, GeneratorExit):
+            # 呼叫端提前停止
+            ok = None
+            raise
+        finally:
+            self.release(backend, started, ok)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backends": [b.stats() for b in self.backends],
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "retries": self.retries,
+            }
+
+    def render_metrics(self):
+        """Prometheus 格式的各後端狀態。"""
+        lines = [
+            "# HELP water_gpt_backend_up Whether the LLM backend passed its last health check and its circuit is not open.",
+            "# TYPE water_gpt_backend_up gauge",
+        ]
+        with self._lock:
+            for b in self.backends:
+                up = int(b.healthy and b.state != "open")
+                lines.append(f'water_gpt_backend_up{{backend="{b.url}"}} {up}')
+            lines += ["# HELP water_gpt_backend_outstanding In-flight requests per LLM backend.",
+                      "# TYPE water_gpt_backend_outstanding gauge"]
+            lines += [f'water_gpt_backend_outstanding{{backend="{b.url}"}} {b.outstanding}' for b in self.backends]
+            lines += ["# HELP water_gpt_backend_requests_total Requests sent to each LLM backend.",
+                      "# TYPE water_gpt_backend_requests_total counter"]
+            lines += [f'water_gpt_backend_requests_total{{backend="{b.url}"}} {b.requests}' for b in self.backends]
+            lines += ["# HELP water_gpt_backend_failures_total Failed requests per LLM backend.",
+                      "# TYPE water_gpt_backend_failures_total counter"]
+            lines += [f'water_gpt_backend_failures_total{{backend="{b.url}"}} {b.failures}' for b in self.backends]
+            lines += ["# HELP water_gpt_hedged_requests_total Hedged duplicate classifier requests.",
+                      "# TYPE water_gpt_hedged_requests_total counter",
+                      f"water_gpt_hedged_requests_total {self.hedges}",
+                      "# HELP water_gpt_hedge_wins_total Hedged requests that answered before the primary.",
+                      "# TYPE water_gpt_hedge_wins_total counter",
+                      f"water_gpt_hedge_wins_total {self.hedge_wins}",
+                      "# HELP water_gpt_backend_retries_total Failed requests retried on another LLM backend.",
+                      "# TYPE water_gpt_backend_retries_total counter",
+                      f"water_gpt_backend_retries_total {self.retries}"]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,256 @@
+import json
+import os
+import re
+import unicodedata
+from collections import deque
+
+COUNTY_DATA_DIR = "./WaterOutageQuery/County_data"
+# 只收錄這些字結尾的路名，避免「大坑」「內寮」這類村里名誤判
+ROAD_SUFFIXES = ("路", "街", "道", "巷")
+# 路名後面的段數（三民路三段、中正路2段）
+SECTION_PATTERN = re.compile(r"^([一二三四五六七八九十]+|\d+)段")
+# 看起來是路名的字，卻沒有對應到路名表
+ROAD_HINT = re.compile(r"路|街|大道")
+TOWN_SUFFIXES = ("區", "鄉", "鎮", "市")
+# 只有縣市時，縣市後面可以接的字；接其他字可能是不在表中的鄉鎮（臺南市里水），交給 LLM
+COUNTY_FOLLOWERS = re.compile(
+    r"^(?:$|[^\w]|\d|會|有|是|停|的|明|今|後|大後|這|那|哪|要|可|能|什|目前|最近|現在|請|查|嗎|呢"
+    r"|地區|區域|全|整|附近|一帶|市區|供水|水|繳|缺|沒|還|也|和|跟|及)"
+)
+
+
+def normalize(text):
+    """全形轉半形、移除空白，並把「台」統一為「臺」。"""
+    text = unicodedata.normalize("NFKC", str(text))
+    return re.sub(r"\s+", "", text).replace("台", "臺")
+
+
+class AhoCorasick:
+    """
+    多字串比對自動機，一次掃描就找出文字中所有出現的關鍵字。
+
+    用法：add() 加入關鍵字後呼叫 build()，再以 find() 查詢。
+    """
+
+    def __init__(self):
+        self.goto = [{}]  # 節點 -> {字元: 下一個節點}
+        self.fail = [0]
+        self.output = [[]]  # 節點 -> [(關鍵字長度, value)]
+
+    def add(self, word, value):
+        node = 0
+        for ch in word:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            node = nxt
+        self.output[node].append((len(word), value))
+
+    def build(self):
+        """以 BFS 建立失敗連結。"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fail = self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[nxt] = self.goto[fail].get(ch, 0)
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+        return self
+
+    def find(self, text):
+        """回傳所有出現的 (起點, 終點, value)，可能互相重疊。"""
+        matches = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for length, value in self.output[node]:
+                matches.append((i + 1 - length, i + 1, value))
+        return matches
+
+
+def longest_matches(matches):
+    """由左至右挑選不重疊的比對結果，同一起點取最長的。"""
+    selected = []
+    end = 0
+    for start, stop, value in sorted(matches, key=lambda m: (m[0], -m[1])):
+        if start >= end:
+            selected.append((start, stop, value))
+            end = stop
+    return selected
+
+
+def load_county_towns(path=COUNTY_DATA_DIR):
+    """讀取 WaterOutageQuery 的 County_data（縣市 -> 鄉鎮市區），讀取失敗時回傳空字典。"""
+    towns = {}
+    try:
+        with open(os.path.join(path, "GetCounty.json"), "r", encoding="utf-8") as f:
+            counties = json.load(f)
+        for county in counties:
+            with open(os.path.join(path, f"{county['value']}.json"), "r", encoding="utf-8") as f:
+                towns[county["label"]] = [town["label"] for town in json.load(f)]
+    except Exception as e:
+        print(f"讀取County_data發生錯誤：{e}")
+    return towns
+
+
+class LocationMatcher:
+    """
+    以字典比對取代 LocationOutageLLM 的地點擷取。
+
+    縣市（含「台/臺」與「台中」這類簡稱）、鄉鎮市區（含「板橋」這類省略區/鄉/鎮/市的寫法）
+    與路名建成同一個 Aho-Corasick 自動機，掃描一次即可找出所有地名。
+    只有結果唯一且不衝突時才回傳，其餘情況回傳 None 交給 LLM。
+
+    Args:
+        location_data (dict): 縣市 -> 鄉鎮市區列表。
+        road_df (DataFrame): taiwan_road_list_2024.csv（city、site_id、road 欄位），None 代表不擷取路名。
+        county_towns (dict): 額外的縣市 -> 鄉鎮市區（County_data），與 location_data 合併。
+
+    路名表中的縣市與鄉鎮市區也會一併收錄（例如不支援查詢的臺北市），
+    讓「臺北市信義區」能正確辨識，再由 validate_location_status 回覆不支援。
+    """
+
+    def __init__(self, location_data, road_df=None, county_towns=None):
+        self.towns = {}
+        sources = [location_data, county_towns or {}]
+        if road_df is not None:
+            road_towns = {}
+            for city, site_id in road_df[["city", "site_id"]].drop_duplicates().itertuples(index=False):
+                if isinstance(city, str) and isinstance(site_id, str) and site_id.startswith(city):
+                    road_towns.setdefault(city, []).append(site_id[len(city):])
+            sources.append(road_towns)
+        for source in sources:
+            for county, towns in source.items():
+                self.towns.setdefault(county, set()).update(towns)
+
+        automaton = AhoCorasick()
+        names = {}  # 正規化後的名稱 -> [(種類, 值)]
+
+        def add(name, kind, value):
+            names.setdefault(normalize(name), []).append((kind, value))
+
+        for county, towns in self.towns.items():
+            add(county, "county", county)
+            add(county[:-1], "county", county)  # 臺中、新北
+            for town in towns:
+                add(town, "town", (county, town))
+                if len(town) >= 3 and town.endswith(TOWN_SUFFIXES):
+                    add(town[:-1], "town", (county, town))  # 板橋、萬巒
+
+        # 路名 -> {(縣市, 鄉鎮市區)}
+        self.roads = {}
+        if road_df is not None:
+            for city, site_id, road in road_df[["city", "site_id", "road"]].itertuples(index=False):
+                if not isinstance(road, str) or len(road) < 2 or not road.endswith(ROAD_SUFFIXES):
+                    continue
+                if road not in self.roads:
+                    add(road, "road", road)
+                self.roads.setdefault(road, set()).add((city, site_id[len(city):]))
+
+        for name, values in names.items():
+            automaton.add(name, values)
+        self.automaton = automaton.build()
+
+    @staticmethod
+    def _resolve(mentions):
+        """
+        找出與所有地名都相符的唯一 (縣市, 鄉鎮市區或 None)。
+
+        每個地名必須是該縣市（或其簡稱），或是該鄉鎮市區；只在有地名非得當成鄉鎮市區
+        才說得通時才填入鄉鎮市區（例如「臺東」視為臺東縣，而不是臺東市）。
+        沒有地名、地名互相衝突（高雄七美）或有多種解讀（北區、新竹）時回傳 None。
+        """
+        if not mentions:
+            return None
+        candidates = set()
+        for counties, towns in mentions:
+            candidates |= {(county, None) for county in counties}
+            candidates |= set(towns) | {(county, None) for county, _ in towns}
+
+        solutions = []
+        for county, town in candidates:
+            needs_town = False
+            for counties, towns in mentions:
+                if county in counties:
+                    continue
+                if town is not None and (county, town) in towns:
+                    needs_town = True
+                    continue
+                break
+            else:
+                if town is None or needs_town:
+                    solutions.append((county, town))
+        if len(solutions) != 1:
+            return None
+        return solutions[0]
+
+    def match(self, text):
+        """
+        擷取縣市、鄉鎮市區與路名。
+
+        Args:
+            text (str): 使用者輸入。
+
+        Returns:
+            dict: 與 LocationOutageLLM 相同格式
+                  {"Counties", "Towns", "addressKeyword", "streetName"}，沒有的欄位為 "null"；
+                  找不到縣市或結果有衝突、歧義時回傳 None。
+        """
+        norm = normalize(text)
+        found = longest_matches(self.automaton.find(norm))
+
+        mentions = []  # 每個地名可能代表的 (縣市集合, (縣市, 鄉鎮市區) 集合)
+        mention_ends = []
+        roads = []  # (終點, 路名)
+        rest = list(norm)  # 扣掉地名之後剩下的文字
+        for start, stop, values in found:
+            counties = {v for kind, v in values if kind == "county"}
+            towns = {v for kind, v in values if kind == "town"}
+            if counties or towns:
+                mentions.append((counties, towns))
+                mention_ends.append(stop)
+                rest[start:stop] = [" "] * (stop - start)
+            else:
+                roads.append((stop, values[0][1]))
+
+        place = self._resolve(mentions)
+        if place is None:
+            return None
+        county, town = place
+        road_starts = {stop - len(normalize(road)) for stop, road in roads}
+        if town is None and any(
+            end not in road_starts and not COUNTY_FOLLOWERS.match(norm[end:]) for end in mention_ends
+        ):
+            return None
+
+        address_keyword = street_name = None
+        valid_roads = []
+        for stop, road in roads:
+            places = self.roads.get(road, set())
+            if any(city == county and (town is None or site == town) for city, site in places):
+                valid_roads.append((stop, road))
+        if len({road for _, road in valid_roads}) > 1:
+            return None
+        if valid_roads:
+            stop, street_name = valid_roads[0]
+            section = SECTION_PATTERN.match(norm[stop:])
+            address_keyword = street_name + section.group(0) if section else street_name
+        elif roads or ROAD_HINT.search("".join(rest)):
+            # 有路名卻不在此縣市/鄉鎮市區的路名表中，交給 LLM
+            return None
+
+        return {
+            "Counties": county,
+            "Towns": town or "null",
+            "addressKeyword": address_keyword or "null",
+            "streetName": street_name or "null",
+        }
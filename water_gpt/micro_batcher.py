@@ -0,0 +1,116 @@
+import asyncio
+import json
+import time
+
+from tracing import Histogram
+
+# 每批請求數的直方圖區間
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+# 佇列等待時間的直方圖區間（秒）
+QUEUE_WAIT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class MicroBatcher:
+    """
+    跨使用者的分類器請求微批次。
+
+    每位使用者的請求由各自的 event loop 送出，因此佇列放在 http_client 的背景 event loop 上，
+    所有使用者共用。同一個分類器在 window 秒內（或累積到 max_batch 筆）的請求合成一批：
+    內容完全相同的請求（熱門快捷訊息）只送一次，結果分給所有等待者；其餘請求在同一時間
+    一起送出，讓後端（vLLM / llama.cpp 的 continuous batching）排進同一批計算。
+
+    OpenAI 相容的 chat completions 不支援一次送多個對話，所以不合併成單一請求。
+
+    Args:
+        http_client (AsyncHTTPClient): 共用的連線池，佇列在它的背景 event loop 上。
+        dispatch (callable): dispatch(payload, timeout) -> awaitable，實際送出一個請求，在背景 event loop 執行。
+        window (float): 收集請求的時間窗（秒）。
+        max_batch (int): 一批最多幾筆，達到就立即送出。
+    """
+
+    def __init__(self, http_client, dispatch, window=0.005, max_batch=16):
+        self.http_client = http_client
+        self.dispatch = dispatch
+        self.window = window
+        self.max_batch = max_batch
+        self._queues = {}  # 分類器名稱 -> [(payload, timeout, future, 加入時間)]
+        self._timers = {}  # 分類器名稱 -> 時間窗結束的 TimerHandle
+        self.queue_wait = Histogram(
+            "water_gpt_batch_queue_wait_seconds", "Time classifier requests wait in the micro-batch queue.",
+            "classifier", QUEUE_WAIT_BUCKETS,
+        )
+        self.batch_size = Histogram(
+            "water_gpt_batch_size", "Classifier requests per micro-batch.", "classifier", BATCH_SIZE_BUCKETS,
+        )
+        self.batched = 0  # 已送出的批次中的請求數
+        self.dispatched = 0  # 實際送出的請求數（相同內容合併後）
+
+    async def submit(self, name, payload, timeout=None):
+        """
+        加入 name 分類器的佇列，等待這一批送出後回傳該請求的 JSON 回應。
+
+        Args:
+            name (str): 分類器名稱，同名的請求才會合成一批。
+            payload (dict): 請求內容。
+            timeout (float): 此請求的逾時秒數；同一批中相同內容的請求取最長的。
+        """
+        future = self.http_client.spawn(self._enqueue(name, payload, timeout))
+        return await asyncio.wrap_future(future)
+
+    async def _enqueue(self, name, payload, timeout):
+        # 只在背景 event loop 內執行，不需要鎖
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self._queues.setdefault(name, [])
+        queue.append((payload, timeout, future, time.perf_counter()))
+        if len(queue) >= self.max_batch:
+            self._flush(name)
+        elif name not in self._timers:
+            self._timers[name] = loop.call_later(self.window, self._flush, name)
+        # 呼叫端取消只取消自己的等待，不影響同一批其他人的請求
+        return await future
+
+    def _flush(self, name):
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._queues.pop(name, [])
+        if not batch:
+            return
+        now = time.perf_counter()
+        self.batch_size.observe(name, len(batch))
+        self.batched += len(batch)
+        groups = {}  # 請求內容的 JSON -> (payload, [(timeout, future)])
+        for payload, timeout, future, enqueued in batch:
+            self.queue_wait.observe(name, now - enqueued)
+            key = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+            groups.setdefault(key, (payload, []))[1].append((timeout, future))
+        for payload, waiters in groups.values():
+            self.dispatched += 1
+            asyncio.ensure_future(self._dispatch(payload, waiters))
+
+    async def _dispatch(self, payload, waiters):
+        timeouts = [timeout for timeout, _ in waiters]
+        timeout = None if None in timeouts else max(timeouts)
+        try:
+            result = await self.dispatch(payload, timeout)
+        except Exception as e:
+            for _, future in waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future in waiters:
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "window": self.window,
+            "max_batch": self.max_batch,
+            "requests": self.batched,
+            "dispatched": self.dispatched,
+            "coalesced": self.batched - self.dispatched,
+        }
+
+    def render_metrics(self):
+        return self.queue_wait.render() + "\n" + self.batch_size.render() + "\n"
@@ -0,0 +1,196 @@
+import json
+import re
+import unicodedata
+
+FAQ_DATA_PATH = "../water_data_content_v3-class.json"
+
+# 問候、答謝、告別（與 greetingLLM 的觸發詞彙一致）
+GREETING_WORDS = [
+    "你好", "您好", "哈囉", "嗨", "hi", "hello", "hey",
+    "早安", "午安", "晚安", "早上好", "下午好", "晚上好",
+    "謝謝", "謝謝你", "謝謝您", "感謝", "感謝你", "感謝您", "謝啦", "多謝", "太好了", "辛苦了",
+    "再見", "掰掰", "拜拜", "bye", "byebye",
+]
+# 問候語後面可接的語助詞
+GREETING_PARTICLES = "啊阿呀喔哦唷囉耶啦嘿~～"
+
+# 出現任一字詞就可能是 OUTAGE/PAYMENT，交給 LLM 判斷
+STATUS_KEYWORDS = [
+    "停水", "沒水", "斷水", "無水", "缺水", "限水", "復水", "供水", "水壓", "減壓", "降壓",
+    "繳", "付費", "付款", "支付", "據點", "服務所", "營業所", "處所",
+    "哪裡", "哪邊", "何處", "在哪", "地點", "附近",
+]
+# 明確的停水查詢句型
+OUTAGE_PATTERN = re.compile(r"停水查詢|查詢停水|查停水|停水資訊|停水公告|停水通知|(會|有|要)停水(嗎|了嗎)|有沒有停水|會不會停水|停不停水|停水了嗎")
+# 明確的繳費地點句型
+PAYMENT_PATTERN = re.compile(r"(繳費|繳水費|繳款).{0,6}(哪裡|哪邊|何處|在哪|地點|據點)|(哪裡|哪邊|何處|在哪|去哪|到哪).{0,6}(繳費|繳水費|繳款)")
+# 出現這些字詞代表是在問原因、規定、手續，不是單純的查詢
+EXPLAIN_WORDS = ["為什麼", "為何", "如何", "怎麼", "怎樣", "申請", "原因", "可否", "是否可以", "規定", "期限", "方式", "手續"]
+# 提問的標記
+QUESTION_MARKERS = ["?", "嗎", "什麼", "甚麼", "如何", "怎麼", "怎樣", "為何", "哪", "多少", "是否", "可否", "能否", "何謂", "何時"]
+# 可能的越獄特徵，出現就不以規則判斷越獄
+JAILBREAK_HINTS = ["忽略", "扮演", "假裝", "現在你是", "你現在是", "指令", "提示詞", "prompt", "dan", "越獄", "開發者", "管理員", "權限", "base64", "繞過", "限制"]
+
+
+def normalize(text):
+    """全形轉半形、轉小寫並移除空白，方便比對。"""
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    return re.sub(r"\s+", "", text)
+
+
+def load_faq_titles(path=FAQ_DATA_PATH):
+    """讀取知識庫的 FAQ 標題（快捷訊息都來自這些標題），讀取失敗時回傳空集合。"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return {item["title"] for item in json.load(f)}
+    except Exception as e:
+        print(f"讀取FAQ檔案發生錯誤：{e}")
+        return set()
+
+
+class PreRouter:
+    """
+    以關鍵字/正規表示式在 LLM 分類器之前先判斷明確的訊息。
+
+    只處理不會有歧義的情況，其餘交給 LLM：
+      - 純問候/答謝/告別：四項都由規則決定
+      - 與 FAQ 標題或熱門快捷訊息完全相同：越獄、情緒、問候語由規則決定
+      - 明確的停水查詢或繳費地點句型：status 由規則決定
+      - 沒有任何停水/繳費相關字詞且目前不在查詢流程中：status 為 NONE
+      - 明確的提問且不含問候語，或已確定是停水/繳費查詢：問候語為「否」
+
+    Args:
+        location_data (dict): 縣市 -> 鄉鎮市區列表，出現地名時 status 交給 LLM。
+        safe_messages (iterable): 已知安全的訊息（FAQ 標題、熱門快捷訊息）。
+    """
+
+    def __init__(self, location_data=None, safe_messages=()):
+        self.safe_messages = {normalize(m) for m in safe_messages}
+        names = set()
+        for county, towns in (location_data or {}).items():
+            for name in [county, county[:2]] + list(towns):
+                names.add(normalize(name))
+                names.add(normalize(name.replace("臺", "台")))
+        self.location_names = names
+        greeting = "|".join(re.escape(w) for w in sorted(GREETING_WORDS, key=len, reverse=True))
+        self.greeting_only = re.compile(rf"^(?:(?:{greeting})[{GREETING_PARTICLES}]*[!,.。，！~]*)+$")
+        self.greeting_any = re.compile(greeting)
+
+    def _has_status_keyword(self, text):
+        if any(word in text for word in STATUS_KEYWORDS):
+            return True
+        return any(name in text for name in self.location_names)
+
+    def route(self, text, current_status="READY"):
+        """
+        判斷訊息中規則能決定的項目。
+
+        Args:
+            text (str): 使用者訊息。
+            current_status (str): 機器人目前的狀態（WaterGPTClient.STATUS）。
+
+        Returns:
+            dict: {"decided": 規則決定的值, "rules": 各項由哪條規則決定}，
+                  鍵為 jailbreak、status、emotion、greeting，沒決定的項目不會出現。
+        """
+        norm = normalize(text)
+        decided, rules = {}, {}
+
+        def decide(name, value, rule):
+            decided[name] = value
+            rules[name] = rule
+
+        if not norm:
+            return {"decided": decided, "rules": rules}
+
+        if self.greeting_only.match(norm):
+            decide("jailbreak", "否", "greeting_only")
+            decide("status", "NONE", "greeting_only")
+            decide("emotion", "happiness" if re.search("謝|感謝|太好了|辛苦了", norm) else "neutral", "greeting_only")
+            decide("greeting", "是", "greeting_only")
+            return {"decided": decided, "rules": rules}
+
+        if norm in self.safe_messages:
+            decide("jailbreak", "否", "safe_message")
+            decide("emotion", "neutral", "safe_message")
+
+        has_explain = any(word in norm for word in EXPLAIN_WORDS)
+        if OUTAGE_PATTERN.search(norm) and not has_explain and "繳" not in norm:
+            decide("status", "OUTAGE", "outage_pattern")
+        elif PAYMENT_PATTERN.search(norm) and "停水" not in norm:
+            decide("status", "PAYMENT", "payment_pattern")
+        elif current_status not in ("OUTAGE", "PAYMENT") and not self._has_status_keyword(norm):
+            decide("status", "NONE", "no_status_keyword")
+
+        if decided.get("status") in ("OUTAGE", "PAYMENT"):
+            # 停水/繳費流程不會用到問候語判斷
+            decide("greeting", "否", "not_needed")
+        elif not self.greeting_any.search(norm) and any(marker in norm for marker in QUESTION_MARKERS):
+            decide("greeting", "否", "question")
+
+        if "jailbreak" in decided and any(hint in norm for hint in JAILBREAK_HINTS):
+            # 保守起見，帶有越獄特徵的一律交給 LLM
+            del decided["jailbreak"], rules["jailbreak"]
+
+        return {"decided": decided, "rules": rules}
+
+
+if __name__ == "__main__":
+    # 以 FAQ 標題與 test/output.log 中的 LLM 判斷結果檢查規則：
+    # 規則決定的值必須與 LLM 相同，並統計有多少訊息可省下 LLM 呼叫
+    import sys
+    sys.path.append("./test")
+    from collections import Counter
+
+    location_data = {}
+    try:
+        from LLMChain import location_data
+    except Exception as e:
+        print(f"無法載入 location_data：{e}")
+
+    titles = load_faq_titles()
+    router = PreRouter(location_data, titles)
+
+    # 解析 output.log：使用者輸入 -> LLM 的 status/問候語/越獄判斷
+    labels = {}
+    current = None
+    with open("./test/output.log", "r", encoding="utf-8") as f:
+        for line in f:
+            match = re.match(r"\d{4}-\d\d-\d\d [\d:,]+ - (.*)", line.rstrip("\n"))
+            if not match:
+                continue
+            message = match.group(1)
+            if message.startswith("使用者輸入:"):
+                current = labels.setdefault(message[len("使用者輸入:"):], {})
+            elif current is None:
+                continue
+            elif message.startswith("Jailbreak檢測結果:"):
+                current["jailbreak"] = message.split(":", 1)[1]
+            elif message.startswith('{"status"'):
+                try:
+                    current["status"] = json.loads(message)["status"]
+                except json.JSONDecodeError:
+                    pass
+            elif message.startswith("問候語判斷結果:"):
+                current["greeting"] = message.split(":", 1)[1]
+
+    messages = sorted(set(titles) | set(labels))
+    skipped = Counter()
+    mismatches = []
+    for text in messages:
+        result = router.route(text)
+        skipped[len(result["decided"])] += 1
+        for name, value in result["decided"].items():
+            expected = labels.get(text, {}).get(name)
+            if expected is not None and expected != value:
+                mismatches.append((text, name, value, expected))
+
+    total = len(messages)
+    at_least_two = sum(count for n, count in skipped.items() if n >= 2)
+    print(f"訊息數：{total}")
+    for n in sorted(skipped):
+        print(f"  規則決定 {n} 項：{skipped[n]}")
+    print(f"至少省下兩次 LLM 呼叫：{at_least_two}/{total} ({at_least_two / total:.1%})")
+    print(f"與 LLM 判斷不一致：{len(mismatches)}")
+    for text, name, value, expected in mismatches:
+        print(f"  {name}: 規則={value} LLM={expected} ｜ {text}")
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+
+
+def prompt_hash(text):
+    """提示詞內容的 12 碼 sha256 雜湊。"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+
+class Prompt:
+    """
+    一個已註冊的系統提示詞。
+
+    static 為固定不變的前綴（import 時建立一次，位元組穩定，後端可重複使用 KV cache）；
+    suffix 為產生變動部分的函式（例如今天日期），結果接在最後面，值不變時沿用同一份字串。
+
+    Args:
+        name (str): 提示詞名稱。
+        static (str): 固定的提示詞內容。
+        suffix (callable): 回傳變動部分的函式，None 代表整份提示詞都固定。
+        slot (int): 建議的後端 slot 編號（llama.cpp 的 id_slot），None 代表不指定。
+    """
+
+    def __init__(self, name, static, suffix=None, slot=None):
+        self.name = name
+        self.static = static
+        self.suffix = suffix
+        self.slot = slot
+        self.version = prompt_hash(static)
+        self._suffix_value = None
+        self._text = static
+        self._lock = threading.Lock()
+
+    @property
+    def text(self):
+        """完整的系統提示詞；變動部分改變（例如換日）時才重新組合。"""
+        if self.suffix is None:
+            return self._text
+        value = self.suffix()
+        with self._lock:
+            if value != self._suffix_value:
+                self._suffix_value = value
+                self._text = self.static + value
+            return self._text
+
+
+class PromptRegistry:
+    """
+    系統提示詞登錄表：每份提示詞只建立一次，並以雜湊標記版本。
+
+    Args:
+        cache_hints (bool): 是否在請求中加入後端的提示詞快取參數（llama.cpp 的 cache_prompt）。
+        slots (int): 可指定的後端 slot 數量，>0 時每份提示詞固定使用同一個 slot（id_slot），
+            讓其 KV cache 留在該 slot；0 代表不指定。
+    """
+
+    def __init__(self, cache_hints=False, slots=0):
+        self.cache_hints = cache_hints
+        self.slots = slots
+        self.prompts = {}
+
+    def register(self, name, static, suffix=None):
+        """登錄提示詞並回傳 Prompt，同名的提示詞會被取代。"""
+        slot = len(self.prompts) % self.slots if self.slots > 0 else None
+        if name in self.prompts:
+            slot = self.prompts[name].slot
+        prompt = Prompt(name, static, suffix=suffix, slot=slot)
+        self.prompts[name] = prompt
+        return prompt
+
+    def get(self, name):
+        return self.prompts[name]
+
+    def version(self, name):
+        return self.prompts[name].version
+
+    def versions(self):
+        """所有提示詞的名稱 -> 版本雜湊。"""
+        return {name: prompt.version for name, prompt in self.prompts.items()}
+
+    def payload(self, name, user_content, model, temperature=None, stream=False):
+        """
+        組出 chat completions 的請求內容：固定的系統提示詞在前，使用者內容在後。
+
+        Args:
+            name (str): 提示詞名稱。
+            user_content (str): 使用者訊息（變動的部分）。
+            model (str): 模型名稱。
+            temperature (float): 溫度，None 代表使用後端預設值。
+            stream (bool): 是否串流。
+
+        Returns:
+            dict: 請求內容。
+        """
+        prompt = self.prompts[name]
+        payload = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": prompt.text},
+                {"role": "user", "content": user_content}
+            ],
+            "stream": stream
+        }
+        if temperature is not None:
+            payload["temperature"] = temperature
+        if self.cache_hints:
+            payload["cache_prompt"] = True
+            if prompt.slot is not None:
+                payload["id_slot"] = prompt.slot
+        return payload
@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class SemanticCache:
+    """
+    RAG 分支的語意快取：以問題的 embedding 找出近似的已回答問題，直接沿用當時的結果。
+
+    每筆資料為 (問題 embedding, 選中的文件標題, 判斷結果, 回答內容)，
+    判斷結果為 "answer"（能回答，回答內容為選中的 FAQ）或 "abstain"（知識庫無法回答）。
+    向量庫重新建立（index_version 改變）時整個快取失效。
+
+    Args:
+        maxsize (int): 最多保留的筆數，超過時淘汰最久沒用到的，0 代表停用。
+        threshold (float): cosine 相似度門檻，達到才算命中。
+    """
+
+    def __init__(self, maxsize=1024, threshold=0.95):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.index_version = None
+        self._entries = OrderedDict()  # 流水號 -> (向量, 文件標題, 判斷結果, 回答內容)
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _check_version(self, index_version):
+        # 只在持有鎖時呼叫
+        if index_version != self.index_version:
+            if self._entries:
+                self._entries.clear()
+                self.invalidations += 1
+            self.index_version = index_version
+
+    def lookup(self, embedding, index_version=None):
+        """
+        找出最相似且達到門檻的快取資料。
+
+        Args:
+            embedding (list): 問題的 embedding。
+            index_version (str): 向量庫版本，與快取不同時先清空快取。
+
+        Returns:
+            dict: {"title", "verdict", "content", "similarity"}，沒有命中時回傳 None。
+        """
+        vector = self._normalize(embedding) if embedding is not None else None
+        with self._lock:
+            self._check_version(index_version)
+            best_id, best_score = None, -1.0
+            if vector is not None and self._entries:
+                ids = list(self._entries)
+                matrix = np.stack([self._entries[i][0] for i in ids])
+                if matrix.shape[1] == vector.shape[0]:
+                    scores = matrix @ vector
+                    best = int(scores.argmax())
+                    best_id, best_score = ids[best], float(scores[best])
+            if best_id is None or best_score < self.threshold:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            _, title, verdict, content = self._entries[best_id]
+            return {"title": title, "verdict": verdict, "content": content, "similarity": best_score}
+
+    def store(self, embedding, title, verdict, content=None, index_version=None):
+        """儲存一筆結果，超過容量時淘汰最久沒用到的資料。"""
+        if self.maxsize <= 0 or embedding is None:
+            return
+        vector = self._normalize(embedding)
+        if vector is None:
+            return
+        with self._lock:
+            self._check_version(index_version)
+            self._entries[self._next_id] = (vector, title, verdict, content)
+            self._next_id += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """清空快取（例如知識庫內容更新但向量庫版本沒變時手動清除）。"""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self.invalidations += 1
+            return count
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "threshold": self.threshold,
+                "index_version": self.index_version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,191 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# 只接受這種格式的 session id，避免從 cookie/header 帶入的值被拿來組檔案路徑
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+SYSTEM_PROMPT = "你是一名客服幫助使用者解決問題"
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def valid_session_id(session_id):
+    return bool(session_id) and bool(SESSION_ID_PATTERN.match(session_id))
+
+
+class Session:
+    """
+    一段對話的狀態：對話歷史、機器人狀態（與 WaterGPTClient.STATUS 相同）、快捷訊息與畫面上的訊息。
+
+    Args:
+        session_id (str): session id。
+        messages_limit (int): 畫面訊息最多保留幾筆。
+        quick_replies_limit (int): 快捷訊息最多保留幾筆。
+    """
+
+    def __init__(self, session_id, messages_limit=100, quick_replies_limit=50):
+        self.id = session_id
+        self.messages_limit = messages_limit
+        self.quick_replies_limit = quick_replies_limit
+        self.last_seen = time.time()
+        self.reset()
+
+    def reset(self):
+        """清除對話（/clear）。"""
+        self.history = [{"role": "system", "content": SYSTEM_PROMPT}]
+        self.STATUS = "READY"
+        self.quick_replies = []
+        self.messages = []
+
+    def add_message(self, role, message):
+        self.messages.append({"role": role, "message": message})
+        del self.messages[:-self.messages_limit]
+
+    def trim(self):
+        """每則訊息處理完後呼叫，讓快捷訊息維持在上限內（RAG 會不斷加入文件標題）。"""
+        del self.quick_replies[:-self.quick_replies_limit]
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "last_seen": self.last_seen,
+            "history": list(self.history),  # History 轉回 list，讀回後由 ask() 再轉成 History
+            "STATUS": self.STATUS,
+            "quick_replies": self.quick_replies,
+            "messages": self.messages,
+        }
+
+    @classmethod
+    def from_dict(cls, data, **limits):
+        session = cls(data["id"], **limits)
+        session.last_seen = data["last_seen"]
+        session.history = data["history"]
+        session.STATUS = data["STATUS"]
+        session.quick_replies = data["quick_replies"]
+        session.messages = data["messages"]
+        return session
+
+
+class SessionStore:
+    """
+    以 session id 區分的對話狀態，讓同一個 process 可以同時服務多位使用者。
+
+    記憶體中最多保留 maxsize 個 session（LRU），閒置超過 idle_ttl 秒的 session 也會移出；
+    有設定 spill_dir 時，移出的 session 寫到磁碟，下次同一個 session id 進來時再讀回，
+    磁碟上超過 spill_ttl 秒沒用到的直接捨棄。
+
+    Args:
+        maxsize (int): 記憶體中最多的 session 數。
+        idle_ttl (float): 閒置多久移出記憶體（秒）。
+        spill_dir (str): 移出的 session 寫入的資料夾，None 代表直接捨棄。
+        spill_ttl (float): 磁碟上的 session 保留多久（秒）。
+        messages_limit (int): 每個 session 的畫面訊息上限。
+        quick_replies_limit (int): 每個 session 的快捷訊息上限。
+    """
+
+    def __init__(self, maxsize=10000, idle_ttl=1800, spill_dir=None, spill_ttl=86400,
+                 messages_limit=100, quick_replies_limit=50):
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self.spill_dir = spill_dir
+        self.spill_ttl = spill_ttl
+        self.limits = {"messages_limit": messages_limit, "quick_replies_limit": quick_replies_limit}
+        self._sessions = OrderedDict()  # session id -> Session，最久沒用到的在前面
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evictions = 0
+        self.spilled = 0
+        self.restored = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, session_id):
+        return os.path.join(self.spill_dir, f"{session_id}.json")
+
+    def _evict(self, session):
+        # 只在持有鎖時呼叫
+        self.evictions += 1
+        if not self.spill_dir:
+            return
+        try:
+            with open(self._spill_path(session.id), "w", encoding="utf-8") as f:
+                json.dump(session.to_dict(), f, ensure_ascii=False)
+            self.spilled += 1
+        except Exception as e:
+            print(f"寫入session發生錯誤：{e}")
+
+    def _restore(self, session_id):
+        # 只在持有鎖時呼叫
+        if not self.spill_dir:
+            return None
+        path = self._spill_path(session_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                session = Session.from_dict(json.load(f), **self.limits)
+        except Exception as e:
+            print(f"讀取session發生錯誤：{e}")
+            session = None
+        finally:
+            os.remove(path)
+        if session is None or time.time() - session.last_seen > self.spill_ttl:
+            return None
+        self.restored += 1
+        return session
+
+    def _expire(self, now):
+        # 最久沒用到的在最前面，從前面移出閒置過久的 session
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_seen <= self.idle_ttl:
+                break
+            self._sessions.popitem(last=False)
+            self._evict(session)
+
+    def get(self, session_id):
+        """
+        取得 session，不存在（或已捨棄）時建立新的。
+
+        Args:
+            session_id (str): session id，不合法時會產生新的。
+
+        Returns:
+            Session: 對應的 session；回傳的 session.id 可能與傳入的不同。
+        """
+        if not valid_session_id(session_id):
+            session_id = new_session_id()
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._restore(session_id)
+            if session is None:
+                session = Session(session_id, **self.limits)
+                self.created += 1
+            session.last_seen = now
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.maxsize:
+                _, oldest = self._sessions.popitem(last=False)
+                self._evict(oldest)
+            return session
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._sessions),
+                "maxsize": self.maxsize,
+                "idle_ttl": self.idle_ttl,
+                "created": self.created,
+                "evictions": self.evictions,
+                "spilled": self.spilled,
+                "restored": self.restored,
+            }
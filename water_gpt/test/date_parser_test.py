@@ -0,0 +1,92 @@
+import sys
+import os
+from datetime import date
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from date_parser import parse_date_range
+
+# 固定「今天」，讓相對日期的結果不隨執行日期改變
+TODAY = date(2025, 5, 20)
+
+# (輸入, 預期的 startDate, 預期的 endDate)；預期為 None 代表無法確定、要交給 LLM
+CASES = [
+    # TimeExtractor 提示詞中的測試案例
+    ("明天會下雨嗎", "2025-05-21", "2025-05-21"),
+    ("6天後會停水嗎", "2025-05-26", "2025-05-26"),
+    ("6/1~6/12 期間會停水嗎?", "2025-06-01", "2025-06-12"),
+    ("5/7 之後會停水嗎?", "2025-05-07", "null"),
+    ("6/30 之前會停水嗎?", "null", "2025-06-30"),
+    ("請問會停水嗎?", "null", "null"),
+    # 相對時間
+    ("今天會停水嗎", "2025-05-20", "2025-05-20"),
+    ("後天台中北區會停水嗎？", "2025-05-22", "2025-05-22"),
+    ("大後天有停水嗎", "2025-05-23", "2025-05-23"),
+    ("3日後板橋區會停水嗎", "2025-05-23", "2025-05-23"),
+    ("十天後會停水嗎", "2025-05-30", "2025-05-30"),
+    ("兩天之後會停水嗎", "2025-05-22", "2025-05-22"),
+    ("二十一天後有停水嗎", "2025-06-10", "2025-06-10"),
+    ("明天以後會停水嗎", "2025-05-21", "null"),
+    ("從今天到後天會停水嗎", "2025-05-20", "2025-05-22"),
+    # 絕對時間
+    ("6/1會停水嗎", "2025-06-01", "2025-06-01"),
+    ("6/01 台中市北區停水嗎", "2025-06-01", "2025-06-01"),
+    ("6月1日會停水嗎", "2025-06-01", "2025-06-01"),
+    ("6月1號會停水嗎", "2025-06-01", "2025-06-01"),
+    ("2025/6/1會停水嗎", "2025-06-01", "2025-06-01"),
+    ("2025-06-01會停水嗎", "2025-06-01", "2025-06-01"),
+    ("2026年1月3日會停水嗎", "2026-01-03", "2026-01-03"),
+    ("114/6/1會停水嗎", "2025-06-01", "2025-06-01"),
+    ("６／１會停水嗎", "2025-06-01", "2025-06-01"),
+    # 時間範圍
+    ("6/1-6/12會停水嗎", "2025-06-01", "2025-06-12"),
+    ("6/1到6/12會停水嗎", "2025-06-01", "2025-06-12"),
+    ("6/1 ～ 6/12 會停水嗎", "2025-06-01", "2025-06-12"),
+    ("6/1~12會停水嗎", "2025-06-01", "2025-06-12"),
+    ("5/7以後會停水嗎", "2025-05-07", "null"),
+    ("6/1起會停水嗎", "2025-06-01", "null"),
+    ("6/30以前會停水嗎", "null", "2025-06-30"),
+    ("到6/30為止會停水嗎", "null", "2025-06-30"),
+    # 沒有時間資訊（地址中的數字不是日期）
+    ("停水查詢", "null", "null"),
+    ("台中市北區會停水嗎", "null", "null"),
+    ("中山路100號會停水嗎", "null", "null"),
+    ("中正路5號有停水嗎", "null", "null"),
+    # 規則不處理，交給 LLM
+    ("下週一會停水嗎", None, None),
+    ("這個星期會停水嗎", None, None),
+    ("月底會停水嗎", None, None),
+    ("明天下午會停水嗎", None, None),
+    ("最近會停水嗎", None, None),
+    ("3天前有停水嗎", None, None),
+    ("昨天為什麼停水", None, None),
+    ("15號會停水嗎", None, None),
+    ("6.1會停水嗎", None, None),
+    ("6月會停水嗎", None, None),
+    ("6/31之前會停水嗎", None, None),
+    ("6/12~6/1會停水嗎", None, None),
+    ("明天或後天會停水嗎", None, None),
+]
+
+
+def check(text, start, end):
+    """回傳 (是否通過, 實際結果)。"""
+    actual = parse_date_range(text, today=TODAY)
+    expected = None if start is None else {"startDate": start, "endDate": end}
+    return actual == expected, actual
+
+
+def test_parse_date_range():
+    failures = []
+    for text, start, end in CASES:
+        ok, actual = check(text, start, end)
+        if not ok:
+            failures.append(f"{text}: 預期 {start}~{end}，實際 {actual}")
+    assert not failures, "\n".join(failures)
+
+
+if __name__ == "__main__":
+    passed = 0
+    for text, start, end in CASES:
+        ok, actual = check(text, start, end)
+        passed += ok
+        print(f"{'✔' if ok else '✘'} {text} -> {actual}" + ("" if ok else f"（預期 {start}~{end}）"))
+    print(f"\n通過 {passed}/{len(CASES)}")
@@ -0,0 +1,55 @@
+import sys
+import os
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+os.chdir(BASE_DIR)  # LLMChain 以相對路徑讀取路名表與 County_data
+from LLMChain import location_data, df
+from location_matcher import LocationMatcher, load_county_towns
+
+# (輸入, 預期的 (Counties, Towns, addressKeyword, streetName))；預期為 None 代表無法確定、要交給 LLM
+CASES = [
+    # LocationOutageLLM 提示詞中的測試案例
+    ("臺南市里水", None),
+    ("高雄七美", None),
+    ("澎湖七美", ("澎湖縣", "七美鄉", "null", "null")),
+    ("萬巒", ("屏東縣", "萬巒鄉", "null", "null")),
+    ("404台中市北區三民路三段129號", ("臺中市", "北區", "三民路三段", "三民路")),
+    ("請問中正路會停水嗎?", None),
+    ("台南市中西區府前路二段229號停水", ("臺南市", "中西區", "府前路二段", "府前路")),
+    ("臺中市會不會停水", ("臺中市", "null", "null", "null")),
+    ("新北板橋六天後會停水嗎?", ("新北市", "板橋區", "null", "null")),
+    ("高雄市三民區中山一路45號", ("高雄市", "三民區", "中山一路", "中山一路")),
+    ("高雄市三民區中山路45號", None),  # 路名表中三民區沒有中山路，交給 LLM 並由 verify_address 判斷
+    ("台中北區明天會停水嗎?", ("臺中市", "北區", "null", "null")),
+    ("北區會停水嗎", None),
+    ("臺北市信義區", ("臺北市", "信義區", "null", "null")),
+    ("信義區會停水嗎", None),
+    ("新竹會停水嗎", None),
+    ("我該去哪裡繳水費?", None),
+]
+
+matcher = LocationMatcher(location_data, df, load_county_towns())
+
+
+def check(text, expected):
+    """回傳 (是否通過, 實際結果)。"""
+    actual = matcher.match(text)
+    return (tuple(actual.values()) if actual else None) == expected, actual
+
+
+def test_location_matcher():
+    failures = []
+    for text, expected in CASES:
+        ok, actual = check(text, expected)
+        if not ok:
+            failures.append(f"{text}: 預期 {expected}，實際 {actual}")
+    assert not failures, "\n".join(failures)
+
+
+if __name__ == "__main__":
+    passed = 0
+    for text, expected in CASES:
+        ok, actual = check(text, expected)
+        passed += ok
+        print(f"{'✔' if ok else '✘'} {text} -> {actual}" + ("" if ok else f"（預期 {expected}）"))
+    print(f"\n通過 {passed}/{len(CASES)}")
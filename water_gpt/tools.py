@@ -1,6 +1,7 @@
 import json
 import asyncio
 from LLMChain import WaterGPTClient
+from session_store import SYSTEM_PROMPT
 
 # 初始化 WaterGPTClient
 water_gpt_client = WaterGPTClient()
@@ -35,7 +36,7 @@ class ChatBot:
         self.headers = {"Content-Type": "application/json"}
         self.history = [{
             "role": "system",
-            "content": "你是一名客服幫助使用者解決問題"
+            "content": SYSTEM_PROMPT
         }]
 
     def set_system_prompt(self, system_prompt):
@@ -45,10 +46,20 @@ class ChatBot:
             "content": system_prompt
         }]
 
-    async def chat_with_llm(self, user_message, quick_replies=[]):
-        """與LLM進行對話"""
-        result, history = await water_gpt_client.ask(user_message, self.history, quick_replies)
-        self.history = history
+    async def chat_with_llm(self, user_message, quick_replies=None, on_event=None, request_id=None, session=None):
+        """
+        與LLM進行對話，on_event 不為 None 時會收到各階段狀態與生成中的文字；request_id 為追蹤用的請求編號。
+        session 不為 None 時使用該 session 的對話歷史、機器人狀態與快捷訊息（多使用者），否則使用此物件自己的。
+        """
+        if session is None:
+            result, history = await water_gpt_client.ask(user_message, self.history, quick_replies, on_event=on_event, request_id=request_id)
+            self.history = history
+            return result
+        result, history = await water_gpt_client.ask(
+            user_message, session.history, session.quick_replies, on_event=on_event, request_id=request_id, state=session,
+        )
+        session.history = history
+        session.trim()
         #print(self.history)
         return result
 
@@ -0,0 +1,173 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# 秒；涵蓋本地規則（毫秒內）到 LLM 逾時（60 秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 目前這則訊息的 Trace；asyncio task 建立時會複製 context，並行的分類器也記錄到同一個 Trace
+_current_trace = contextvars.ContextVar("water_gpt_trace", default=None)
+
+
+class Histogram:
+    """
+    Prometheus 格式的直方圖，依單一標籤分組。
+
+    Args:
+        name (str): 指標名稱。
+        help_text (str): 指標說明。
+        label (str): 分組標籤名稱。
+        buckets (tuple): 各區間的上限（秒）。
+    """
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}  # 標籤值 -> [各區間計數, 總和, 總數]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.setdefault(label_value, [[0] * len(self.buckets), 0.0, 0])
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        """輸出 Prometheus text exposition format 的文字。"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for value, (counts, total, count) in sorted(self._series.items()):
+                label = f'{self.label}="{value}"'
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{{{label}}} {total:.6f}")
+                lines.append(f"{self.name}_count{{{label}}} {count}")
+        return "\n".join(lines)
+
+
+class Trace:
+    """
+    一則訊息的追蹤紀錄：各階段的耗時（span）與決策路徑。
+
+    Args:
+        request_id (str): 請求編號，None 時自動產生。
+    """
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.start_time = time.time()
+        self.spans = []  # [{"name", "start", "duration", ...}]，start 為相對於訊息開始的秒數
+        self.path = []  # ["jailbreak:否", "status:NONE", ...]
+        self.duration = None
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def add_span(self, name, start, duration, **attrs):
+        self.spans.append({"name": name, "start": round(start - self.started, 6), "duration": round(duration, 6), **attrs})
+
+    def decide(self, stage, result):
+        self.path.append(f"{stage}:{result}")
+
+    @property
+    def exit_stage(self):
+        """最後一個決策的階段名稱，代表訊息在哪個階段結束（回應直方圖的標籤）。"""
+        return self.path[-1].split(":", 1)[0] if self.path else "none"
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "timestamp": self.start_time,
+            "duration": round(self.duration if self.duration is not None else self.elapsed(), 6),
+            "path": self.path,
+            "spans": self.spans,
+        }
+
+
+class Tracer:
+    """
+    ask() 流程的各階段耗時追蹤。
+
+    tracer.request() 包住一則訊息，期間以 tracer.span(name) 記錄各階段耗時、
+    tracer.decide(stage, result) 記錄決策路徑；訊息結束時整份紀錄以一行 JSON 寫入 log，
+    耗時同時累計到 Prometheus 直方圖（render_metrics()）。
+
+    Args:
+        log_path (str): JSON log 的檔案路徑，None 代表只寫入 logging 的 root logger。
+        buckets (tuple): 直方圖的區間上限（秒）。
+    """
+
+    def __init__(self, log_path=None, buckets=DEFAULT_BUCKETS):
+        self.stage_seconds = Histogram("water_gpt_stage_seconds", "Latency of each pipeline stage in seconds.", "stage", buckets)
+        self.request_seconds = Histogram("water_gpt_request_seconds", "End-to-end latency of ask() in seconds.", "exit_stage", buckets)
+        self.logger = logging.getLogger("water_gpt.trace")
+        if log_path:
+            handler = logging.FileHandler(log_path, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+
+    @staticmethod
+    def current():
+        """目前這則訊息的 Trace，不在 request() 中時回傳 None。"""
+        return _current_trace.get()
+
+    @contextmanager
+    def request(self, request_id=None):
+        """追蹤一則訊息，yield 該訊息的 Trace。"""
+        trace = Trace(request_id)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        except BaseException as e:
+            trace.decide("error", type(e).__name__)
+            raise
+        finally:
+            _current_trace.reset(token)
+            trace.duration = trace.elapsed()
+            self.request_seconds.observe(trace.exit_stage, trace.duration)
+            self.logger.info(json.dumps(trace.to_dict(), ensure_ascii=False))
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        記錄一個階段的耗時；不在 request() 中時仍會累計到直方圖。
+
+        被取消或發生例外時，span 會多一個 status 欄位（cancelled / 例外名稱）。
+        """
+        start = time.perf_counter()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs["status"] = "cancelled" if type(e).__name__ == "CancelledError" else type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.stage_seconds.observe(name, duration)
+            trace = _current_trace.get()
+            if trace is not None:
+                trace.add_span(name, start, duration, **attrs)
+
+    def decide(self, stage, result):
+        """在目前這則訊息的決策路徑加上一步。"""
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.decide(stage, result)
+
+    def render_metrics(self):
+        return self.stage_seconds.render() + "\n" + self.request_seconds.render() + "\n"